@@ -1,32 +1,43 @@
+import time
+_RUN_T0 = time.perf_counter()   # Streamlit re-executes this module on every rerun; see record_run()
 import streamlit as st
-import anthropic
-import requests
+import asyncio
+import threading
 import concurrent.futures
+import contextlib
+import atexit
+import collections
+import copy
+import bisect
+import contextvars
+import email.utils
+import http.server
+import queue
 import base64
 import io
 import urllib.parse
 import json
+import sqlite3
 import os
 import uuid
+import math
+import re
+import html
+import hashlib
+import importlib.util
+import logging
 from datetime import datetime, timedelta, timezone
-from typing import Optional
 
-try:
-    import pdfplumber
-    PDF_SUPPORT = True
-except ImportError:
-    PDF_SUPPORT = False
+import pdf_extract
 
-try:
-    from bs4 import BeautifulSoup
-    BS4_SUPPORT = True
-except ImportError:
-    BS4_SUPPORT = False
-
-st.set_page_config(page_title="Nexus AI", page_icon="⬡", layout="wide", initial_sidebar_state="expanded")
+# anthropic, httpx, requests, pdfplumber, bs4 and PIL are imported where they are first used, so a cold start
+# and the first paint don't wait on them
+@st.cache_resource
+def _has_module(name):
+    return importlib.util.find_spec(name) is not None
 
 # Enhanced visual design with better hierarchy, spacing, and polish
-st.markdown("""
+PAGE_CSS = """
 <style>
 @import url('https://fonts.googleapis.com/css2?family=Inter:wght@400;500;600;700&family=JetBrains+Mono:wght@400;500&display=swap');
 
@@ -120,7 +131,12 @@ html,body,[class*="css"]{
     border-radius:8px!important;
 }
 </style>
-""", unsafe_allow_html=True)
+"""
+
+def setup_page():
+    # Called from main() rather than at import, so batch.py can import this module without a browser session
+    st.set_page_config(page_title="Nexus AI", page_icon="⬡", layout="wide", initial_sidebar_state="expanded")
+    st.markdown(PAGE_CSS,unsafe_allow_html=True)
 
 # ─── AI Config with enhanced visuals ──────────────────────────────
 AI_CONFIG = {
@@ -144,9 +160,19 @@ SYNTH_SYSTEM = "You are a neutral expert moderator synthesizing a multi-AI discu
 FOLLOWUP_SYNTH_SYSTEM = "You are a neutral expert moderator. Synthesize the five AIs follow-up responses into the best updated answer, incorporating new insights that refine the previous synthesis."
 FACTCHECK_SYSTEM = "You are Perplexity AI, a rigorous fact-checker with real-time web access. Your job: verify the synthesized answer below with healthy skepticism. Check each major claim against current sources. Flag potential hallucinations, outdated info, or unsupported assertions. Cite sources where you verify or contradict claims. If everything checks out, say so. Be constructively critical."
 
+CLAIMCHECK_SYSTEM = "You are Perplexity AI, a rigorous fact-checker with real-time web access. You are given one claim taken from a synthesized answer, usually with the sentence before it as context. Check the claim against current sources. Start your reply with exactly one line: VERDICT: SUPPORTED, VERDICT: DISPUTED or VERDICT: UNVERIFIED. Follow it with one or two sentences of evidence, citing a source."
+
+CLAIMBATCH_SYSTEM = "You are Perplexity AI, a rigorous fact-checker with real-time web access. You are given numbered claims taken from a synthesized answer, each with the sentence before it as context. Check every claim against current sources. Reply with exactly one line per claim, in order, in the form: N. VERDICT: SUPPORTED, DISPUTED or UNVERIFIED — one sentence of evidence, citing a source."
+
+@st.cache_resource
+def _secrets():
+    # secrets.toml is parsed once per process; no file just means everything comes from the environment
+    try: return st.secrets.to_dict()
+    except Exception: return {}
+
 def get_secret(key):
-    try: return st.secrets[key]
-    except: return None
+    # Streamlit secrets first, then the environment (headless runs such as batch.py have no secrets.toml)
+    return _secrets().get(key) or os.environ.get(key)
 
 ANTHROPIC_KEY  = get_secret("ANTHROPIC_API_KEY")
 GEMINI_KEY     = get_secret("GEMINI_API_KEY")
@@ -156,8 +182,19 @@ DEEPSEEK_KEY   = get_secret("DEEPSEEK_API_KEY")
 SUPABASE_URL   = get_secret("SUPABASE_URL")
 SUPABASE_KEY   = get_secret("SUPABASE_KEY")
 
-HISTORY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "nexus_history.json")
-STORAGE_MODE = "supabase" if (SUPABASE_URL and SUPABASE_KEY) else "local"
+# Endpoint overrides such as NEXUS_OPENAI_URL point a provider at a proxy or at bench.py's local mock
+PROVIDER_URLS = {p:get_secret(f"NEXUS_{p.upper()}_URL") or url for p,url in {
+    "anthropic":"https://api.anthropic.com","gemini":"https://generativelanguage.googleapis.com","openai":"https://api.openai.com/v1",
+    "perplexity":"https://api.perplexity.ai","deepseek":"https://api.deepseek.com/v1"}.items()}
+
+DATA_DIR     = get_secret("NEXUS_DATA_DIR") or os.path.dirname(os.path.abspath(__file__))
+HISTORY_FILE = os.path.join(DATA_DIR, "nexus_history.json")
+HISTORY_DB   = os.path.join(DATA_DIR, "nexus_history.db")
+STORAGE_MODE = get_secret("NEXUS_STORAGE") or ("supabase" if (SUPABASE_URL and SUPABASE_KEY) else "local")
+
+def _requests():
+    import requests   # only Supabase mode needs it
+    return requests
 
 def _supa_headers():
     return {"apikey":SUPABASE_KEY,"Authorization":f"Bearer {SUPABASE_KEY}","Content-Type":"application/json","Prefer":"resolution=merge-duplicates"}
@@ -165,62 +202,448 @@ def _supa_headers():
 def _supa_url(path=""):
     return f"{SUPABASE_URL.rstrip('/')}/rest/v1/nexus_discussions{path}"
 
-def _sb_load_history():
+HISTORY_PAGE = 50
+SUMMARY_COLS = "id,question,created_at,followup_count"
+
+SB_COLUMNS = ("id","created_at","question","phase","r1","r2","synthesis","factcheck","followups","context_summary")
+
+def _sb_decode(row):
+    for col in ("r1","r2","followups","meta"):
+        if isinstance(row.get(col),str):
+            try: row[col]=json.loads(row[col])
+            except: pass
+    meta=row.pop("meta",None)
+    return {**meta,**row} if isinstance(meta,dict) else row
+
+def _sb_list_history(days=0,limit=HISTORY_PAGE,offset=0):
+    # Projected, range-paginated listing; the date filter runs in Postgres
+    params={"select":SUMMARY_COLS,"order":"created_at.desc"}
+    if days>0: params["created_at"]=f"gte.{(datetime.now(timezone.utc).replace(tzinfo=None)-timedelta(days=days)).isoformat()}"
+    headers={**_supa_headers(),"Prefer":"","Range-Unit":"items","Range":f"{offset}-{offset+limit-1}"}
     try:
-        r=requests.get(_supa_url(),headers={**_supa_headers(),"Prefer":""},params={"select":"*","order":"created_at.desc"},timeout=10)
-        r.raise_for_status(); rows=r.json()
-        for row in rows:
-            for col in ("r1","r2","followups"):
-                if isinstance(row.get(col),str):
-                    try: row[col]=json.loads(row[col])
-                    except: pass
-        return rows
+        r=_requests().get(_supa_url(),headers=headers,params=params,timeout=10)
+        if r.status_code==400 and "followup_count" in r.text:
+            # Table predates the generated followup_count column (see README) — list without badges
+            r=_requests().get(_supa_url(),headers=headers,params={**params,"select":"id,question,created_at"},timeout=10)
+        r.raise_for_status(); return r.json()
     except Exception as e: st.warning(f"Supabase read error: {e}"); return []
 
-def _sb_save_discussion(disc):
-    payload={"id":disc["id"],"created_at":disc.get("created_at",datetime.now(timezone.utc).replace(tzinfo=None).isoformat()),
-             "question":disc.get("question",""),"phase":disc.get("phase",0),"r1":disc.get("r1",{}),"r2":disc.get("r2",{}),
-             "synthesis":disc.get("synthesis","") or "","factcheck":disc.get("factcheck","") or "",
-             "followups":disc.get("followups",[]),"context_summary":disc.get("context_summary","")}
-    try: r=requests.post(_supa_url(),headers={**_supa_headers(),"Prefer":"resolution=merge-duplicates"},json=payload,timeout=10); r.raise_for_status()
-    except Exception as e: st.warning(f"Supabase save error: {e}")
+def _sb_get_discussion(disc_id):
+    try:
+        r=_requests().get(_supa_url(),headers={**_supa_headers(),"Prefer":""},params={"select":"*","id":f"eq.{disc_id}"},timeout=10)
+        r.raise_for_status(); rows=r.json()
+        return _sb_decode(rows[0]) if rows else None
+    except Exception as e: st.warning(f"Supabase read error: {e}"); return None
+
+def _sb_payload(disc):
+    return {"id":disc["id"],"created_at":disc.get("created_at",datetime.now(timezone.utc).replace(tzinfo=None).isoformat()),
+            "question":disc.get("question",""),"phase":disc.get("phase",0),"r1":disc.get("r1",{}),"r2":disc.get("r2",{}),
+            "synthesis":disc.get("synthesis","") or "","factcheck":disc.get("factcheck","") or "",
+            "followups":disc.get("followups",[]),"context_summary":disc.get("context_summary",""),
+            "meta":{k:v for k,v in disc.items() if k not in SB_COLUMNS}}
+
+def _sb_write(saves,deletes):
+    # One bulk upsert and one bulk delete per batch; errors propagate so the persistence queue can retry
+    if saves:
+        payload=[_sb_payload(d) for d in saves]
+        r=_requests().post(_supa_url(),headers={**_supa_headers(),"Prefer":"resolution=merge-duplicates"},json=payload,timeout=10)
+        if r.status_code==400 and "meta" in r.text:
+            # Table predates the meta column (see README) — save the core columns only
+            for row in payload: row.pop("meta")
+            r=_requests().post(_supa_url(),headers={**_supa_headers(),"Prefer":"resolution=merge-duplicates"},json=payload,timeout=10)
+        r.raise_for_status()
+    if deletes:
+        r=_requests().delete(_supa_url(),headers={**_supa_headers(),"Prefer":""},params={"id":f"in.({','.join(deletes)})"},timeout=10); r.raise_for_status()
+
+_UPSERT_SQL = ("INSERT INTO discussions(id,created_at,question,phase,followup_count,body) VALUES(?,?,?,?,?,?) "
+               "ON CONFLICT(id) DO UPDATE SET created_at=excluded.created_at,question=excluded.question,phase=excluded.phase,"
+               "followup_count=excluded.followup_count,body=excluded.body")
+
+def _db_row(disc):
+    return (disc["id"],disc.get("created_at") or "",disc.get("question",""),disc.get("phase",0),len(disc.get("followups",[])),json.dumps(disc,ensure_ascii=False))
+
+def _search_fields(disc):
+    fus=disc.get("followups",[])
+    return (disc.get("question",""),disc.get("synthesis") or "",disc.get("factcheck") or "",
+            "\n".join(f"{fu.get('question','')}\n{fu.get('synthesis','')}\n{fu.get('factcheck','')}" for fu in fus))
+
+def _local_write(conn,disc,fts):
+    conn.execute(_UPSERT_SQL,_db_row(disc))
+    if fts:
+        conn.execute("DELETE FROM discussions_fts WHERE id=?",(disc["id"],))
+        conn.execute("INSERT INTO discussions_fts(id,question,synthesis,factcheck,followups) VALUES(?,?,?,?,?)",(disc["id"],*_search_fields(disc)))
+
+def _import_json_history(conn,fts):
+    # One-shot migration of the old whole-file JSON history; the file is renamed so it never imports twice
+    if not os.path.exists(HISTORY_FILE): return
+    try:
+        with open(HISTORY_FILE,"r",encoding="utf-8") as f: history=json.load(f)
+        with conn:
+            for d in history:
+                if d.get("id"): _local_write(conn,d,fts)
+            _local_bump(conn)
+        os.replace(HISTORY_FILE,HISTORY_FILE+".imported")
+    except Exception as e: st.warning(f"History import error: {e}")
+
+@st.cache_resource
+def _init_local_db():
+    if sqlite3.sqlite_version_info<(3,24): raise RuntimeError(f"local history needs SQLite 3.24+ for upserts, found {sqlite3.sqlite_version}")
+    conn=sqlite3.connect(HISTORY_DB,timeout=10)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS discussions(id TEXT PRIMARY KEY,created_at TEXT NOT NULL DEFAULT '',question TEXT NOT NULL DEFAULT '',"
+                 "phase INTEGER NOT NULL DEFAULT 0,followup_count INTEGER NOT NULL DEFAULT 0,body TEXT NOT NULL)")
+    conn.execute("CREATE INDEX IF NOT EXISTS discussions_created_at ON discussions(created_at)")
+    conn.execute("CREATE TABLE IF NOT EXISTS meta(k TEXT PRIMARY KEY,v INTEGER NOT NULL)")
+    conn.execute("INSERT OR IGNORE INTO meta VALUES('history',0)"); conn.commit()
+    try:
+        new=not conn.execute("SELECT 1 FROM sqlite_master WHERE name='discussions_fts'").fetchone()
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS discussions_fts USING fts5(id UNINDEXED,question,synthesis,factcheck,followups,tokenize='porter unicode61')")
+        if new:
+            with conn:
+                for (b,) in conn.execute("SELECT body FROM discussions").fetchall():
+                    d=json.loads(b); conn.execute("INSERT INTO discussions_fts(id,question,synthesis,factcheck,followups) VALUES(?,?,?,?,?)",(d["id"],*_search_fields(d)))
+        fts=True
+    except sqlite3.OperationalError: fts=False
+    _import_json_history(conn,fts); conn.close()
+    return {"path":HISTORY_DB,"fts":fts}
+
+def _db():
+    conn=sqlite3.connect(_init_local_db()["path"],timeout=10)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+def _local_bump(conn):
+    # History version, bumped in the same transaction as every write so other processes can detect stale indexes
+    # (UPDATE … RETURNING would need SQLite 3.35; the write transaction already keeps the pair atomic)
+    conn.execute("UPDATE meta SET v=v+1 WHERE k='history'")
+    return conn.execute("SELECT v FROM meta WHERE k='history'").fetchone()[0]
+
+def _local_version():
+    try:
+        conn=_db()
+        try: return conn.execute("SELECT v FROM meta WHERE k='history'").fetchone()[0]
+        finally: conn.close()
+    except Exception: return None
 
-def _sb_delete_discussion(disc_id):
-    try: r=requests.delete(_supa_url(),headers={**_supa_headers(),"Prefer":""},params={"id":f"eq.{disc_id}"},timeout=10); r.raise_for_status()
-    except Exception as e: st.warning(f"Supabase delete error: {e}")
+def _local_list_history(days=0,limit=HISTORY_PAGE,offset=0):
+    where,args=("WHERE created_at>=?",[(datetime.now(timezone.utc).replace(tzinfo=None)-timedelta(days=days)).isoformat()]) if days>0 else ("",[])
+    try:
+        conn=_db(); conn.row_factory=sqlite3.Row
+        try: return [dict(r) for r in conn.execute(f"SELECT {SUMMARY_COLS} FROM discussions {where} ORDER BY created_at DESC LIMIT ? OFFSET ?",args+[limit,offset])]
+        finally: conn.close()
+    except Exception as e: st.warning(f"Local read error: {e}"); return []
 
-def _local_load_history():
+def _local_get_discussion(disc_id):
+    try:
+        conn=_db()
+        try: row=conn.execute("SELECT body FROM discussions WHERE id=?",(disc_id,)).fetchone()
+        finally: conn.close()
+        return json.loads(row[0]) if row else None
+    except Exception as e: st.warning(f"Local read error: {e}"); return None
+
+def _local_write_batch(saves,deletes):
+    # The whole batch is one transaction with one version bump, so a crash leaves either all of it or none
+    conn=_db(); fts=_init_local_db()["fts"]
     try:
-        if os.path.exists(HISTORY_FILE):
-            with open(HISTORY_FILE,"r",encoding="utf-8") as f: return json.load(f)
-    except: pass
-    return []
+        with conn:
+            for d in saves: _local_write(conn,d,fts)
+            conn.executemany("DELETE FROM discussions WHERE id=?",[(i,) for i in deletes])
+            if fts: conn.executemany("DELETE FROM discussions_fts WHERE id=?",[(i,) for i in deletes])
+            return _local_bump(conn)
+    finally: conn.close()
 
-def _local_save_history(history):
+# ─── Full-text search ──────────────────────────────────────────────
+SEARCH_LIMIT = 20
+
+def _fts_query(q):
+    words=re.findall(r"\w+",q)
+    return " ".join(f'"{w}"' for w in words[:-1])+(f' "{words[-1]}"*' if words else "")
+
+def _local_search(q,limit=SEARCH_LIMIT):
+    try:
+        conn=_db()
+        try:
+            if _init_local_db()["fts"]:
+                if not _fts_query(q).strip(): return []
+                rows=conn.execute("SELECT d.id,d.question,d.created_at,d.followup_count,snippet(discussions_fts,-1,'[[',']]','…',14) "
+                                  "FROM discussions_fts JOIN discussions d ON d.id=discussions_fts.id WHERE discussions_fts MATCH ? "
+                                  "ORDER BY bm25(discussions_fts,0,8,2,1,1) LIMIT ?",(_fts_query(q),limit)).fetchall()
+            else:
+                rows=conn.execute("SELECT id,question,created_at,followup_count,substr(question,1,120) FROM discussions "
+                                  "WHERE body LIKE ? ORDER BY created_at DESC LIMIT ?",(f"%{q}%",limit)).fetchall()
+        finally: conn.close()
+        return [{"id":r[0],"question":r[1],"created_at":r[2],"followup_count":r[3],"snippet":r[4]} for r in rows]
+    except Exception as e: st.warning(f"Local search error: {e}"); return []
+
+def _sb_search(q,limit=SEARCH_LIMIT):
+    # Ranked Postgres full-text search through the nexus_search RPC (see README)
     try:
-        with open(HISTORY_FILE,"w",encoding="utf-8") as f: json.dump(history,f,ensure_ascii=False,indent=2)
-    except Exception as e: st.warning(f"Local save error: {e}")
+        r=_requests().post(f"{SUPABASE_URL.rstrip('/')}/rest/v1/rpc/nexus_search",headers={**_supa_headers(),"Prefer":""},json={"q":q,"n":limit},timeout=10)
+        r.raise_for_status(); return r.json()
+    except Exception as e: st.warning(f"Supabase search error: {e}"); return []
+
+def search_history(q,limit=SEARCH_LIMIT):
+    if not q.strip(): return []
+    if STORAGE_MODE=="supabase": return _sb_search(q,limit)
+    return _local_search(q,limit)
 
-def _local_save_discussion(disc):
-    history=_local_load_history()
-    for i,d in enumerate(history):
-        if d.get("id")==disc["id"]: history[i]=disc; _local_save_history(history); return
-    history.append(disc); _local_save_history(history)
+def snippet_html(snip):
+    return html.escape(snip or "").replace("[[",'<mark style="background:rgba(91,141,239,0.3);color:#E1E8F0;border-radius:3px;padding:0 2px">').replace("]]","</mark>")
 
-def _local_delete_discussion(disc_id):
-    _local_save_history([d for d in _local_load_history() if d.get("id")!=disc_id])
+def list_history(days=0,limit=HISTORY_PAGE,offset=0):
+    if STORAGE_MODE=="supabase": return _sb_list_history(days,limit,offset)
+    return _local_list_history(days,limit,offset)
 
-def load_history():
-    if STORAGE_MODE=="supabase": return _sb_load_history()
-    return _local_load_history()
+def get_discussion(disc_id):
+    # Writes still queued win over what storage has
+    queued,disc=get_persist_queue().peek(disc_id)
+    if queued: return disc
+    if STORAGE_MODE=="supabase": return _sb_get_discussion(disc_id)
+    return _local_get_discussion(disc_id)
 
 def save_discussion(disc):
-    if STORAGE_MODE=="supabase": _sb_save_discussion(disc)
-    else: _local_save_discussion(disc)
+    get_persist_queue().put(disc["id"],disc); get_history_index().upsert(disc)
 
 def delete_discussion(disc_id):
-    if STORAGE_MODE=="supabase": _sb_delete_discussion(disc_id)
-    else: _local_delete_discussion(disc_id)
+    # Stop a running job first, or its next checkpoint would save the discussion again
+    get_job_runner().cancel(disc_id); get_persist_queue().put(disc_id,None); get_history_index().remove(disc_id); get_bodies().discard(disc_id)
+
+# ─── Write-behind persistence: saves are queued, coalesced per discussion and written in batches ───
+PERSIST = {"batch":25,"linger":0.05,"backoff":0.5,"max_backoff":30,"attempts":5}
+
+class PersistQueue:
+    # id → latest discussion (None = delete). A writer thread drains it in batches; a failed batch goes back
+    # to the front of the queue, unless a newer save superseded it, and its items are retried one at a time with
+    # capped backoff. An item that still fails after PERSIST["attempts"] tries is set aside, so the rest can drain.
+    def __init__(self):
+        self.cond=threading.Condition(); self.pending={}; self.inflight={}
+        self.failures,self.written,self.last_error=0,0,None
+        self.solo=set(); self.attempts=collections.Counter(); self.dropped={}   # dropped: id → (discussion, error)
+        threading.Thread(target=self._run,name="nexus-persist",daemon=True).start()
+
+    def put(self,disc_id,disc):
+        with self.cond:
+            self.pending.pop(disc_id,None); self.pending[disc_id]=copy.deepcopy(disc); self.attempts.pop(disc_id,None); self.cond.notify_all()
+
+    def retry(self,disc_id):
+        with self.cond:
+            if disc_id in self.dropped and disc_id not in self.pending: self.put(disc_id,self.dropped[disc_id][0])
+
+    def peek(self,disc_id):
+        # A set-aside save still shadows storage, so this process keeps showing what it failed to write
+        with self.cond:
+            for q in (self.pending,self.inflight):
+                if disc_id in q: return True,copy.deepcopy(q[disc_id])
+            if disc_id in self.dropped: return True,copy.deepcopy(self.dropped[disc_id][0])
+        return False,None
+
+    def queued(self):
+        # Summaries of queued saves and the ids of queued deletes, for rebuilding the history index
+        with self.cond:
+            ops={**self.inflight,**self.pending}
+            return [_summary(d) for d in ops.values() if d],[i for i,d in ops.items() if d is None]
+
+    def depth(self):
+        with self.cond: return len(self.pending)+len(self.inflight)
+
+    def flush(self,timeout=None):
+        deadline=None if timeout is None else time.monotonic()+timeout
+        with self.cond:
+            while self.pending or self.inflight:
+                left=None if deadline is None else deadline-time.monotonic()
+                if left is not None and left<=0: return False
+                self.cond.wait(left)
+        return True
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending: self.cond.wait()
+            time.sleep(PERSIST["linger"])   # let a burst of saves coalesce into one batch
+            with self.cond:
+                ids=[i for i in self.pending if i in self.solo][:1] or list(self.pending)[:PERSIST["batch"]]
+                self.inflight={i:self.pending.pop(i) for i in ids}; batch=self.inflight
+            try:
+                saves,deletes=[d for d in batch.values() if d],[i for i,d in batch.items() if d is None]
+                ver=_sb_write(saves,deletes) if STORAGE_MODE=="supabase" else _local_write_batch(saves,deletes); err=None
+            except Exception as e: err=e
+            with self.cond:
+                self.inflight={}
+                dropped=None
+                if err:
+                    back={i:d for i,d in batch.items() if i not in self.pending}
+                    self.failures+=1; self.last_error=f"{type(err).__name__}: {str(err)[:200]}"
+                    if len(batch)>1: self.solo.update(batch)   # one bad row shouldn't hold up the rest of its batch
+                    else:
+                        self.attempts[ids[0]]+=1
+                        if ids[0] in back and self.attempts[ids[0]]>=PERSIST["attempts"]:
+                            dropped=ids[0]; self.dropped[dropped]=(back.pop(dropped),self.last_error); self.solo.discard(dropped); del self.attempts[dropped]
+                    self.pending={**back,**self.pending}
+                else:
+                    self.failures,self.last_error=0,None; self.written+=len(batch)
+                    for i in batch: self.solo.discard(i); self.attempts.pop(i,None); self.dropped.pop(i,None)
+                self.cond.notify_all()
+            get_metrics().inc("nexus_persist_batches_total",{"outcome":"error" if err else "ok"})
+            if dropped:
+                get_metrics().inc("nexus_persist_dropped_total")
+                logging.getLogger("nexus").error("Gave up saving discussion %s after %d attempts: %s",dropped,PERSIST["attempts"],self.last_error)
+            if err: time.sleep(min(PERSIST["max_backoff"],PERSIST["backoff"]*2**(self.failures-1)))
+            else: get_history_index().written(ver)
+
+    def summary(self):
+        n=self.depth()
+        if self.dropped: return f" · ⚠ {len(self.dropped)} not saved ({next(reversed(self.dropped.values()))[1][:60]})"
+        if self.last_error: return f" · ⚠ {n} unsaved, retrying ({self.last_error[:60]})"
+        return f" · {n} saving" if n else ""
+
+@st.cache_resource
+def get_persist_queue():
+    q=PersistQueue(); atexit.register(q.flush,PERSIST["max_backoff"])
+    return q
+
+# ─── Session memory: sessions hold a discussion id; bodies live in one shared, byte-budgeted LRU ───
+BODY_CACHE_BYTES  = 128*1024*1024
+MEMORY_CEILING_MB = float(get_secret("NEXUS_MEMORY_CEILING_MB") or 0)   # process RSS that triggers eviction; 0 = none
+MEMORY_CHECK_SECS = 5
+
+def _approx_bytes(o):
+    if isinstance(o,str): return len(o)
+    if isinstance(o,dict): return 64+sum(_approx_bytes(k)+_approx_bytes(v) for k,v in o.items())
+    if isinstance(o,(list,tuple)): return 56+sum(map(_approx_bytes,o))
+    return 16
+
+def _rss_mb():
+    try:
+        with open("/proc/self/statm") as f: return int(f.read().split()[1])*os.sysconf("SC_PAGE_SIZE")/2**20
+    except (OSError,ValueError,AttributeError): return None
+
+class BodyCache:
+    # id → discussion body, shared by every session viewing it. Evicting only drops this copy: every body is
+    # also in storage or the persistence queue, and is reloaded the next time a session views it.
+    def __init__(self,max_bytes=BODY_CACHE_BYTES):
+        self.max_bytes=max_bytes; self.items=collections.OrderedDict(); self.used=0; self.lock=threading.Lock(); self.checked=0.0
+
+    def get(self,disc_id):
+        with self.lock:
+            e=self.items.get(disc_id)
+            if e: self.items.move_to_end(disc_id); return e[0]
+
+    def put(self,disc):
+        size=_approx_bytes(disc)
+        with self.lock:
+            old=self.items.pop(disc["id"],None)
+            if old: self.used-=old[1]
+            self.items[disc["id"]]=(disc,size); self.used+=size; self._evict(self.max_bytes)
+        self._check_ceiling()
+
+    def refresh(self,disc):
+        # A job's checkpoint replaces the body only for discussions someone is viewing
+        with self.lock: cached=disc["id"] in self.items
+        if cached: self.put(disc)
+
+    def discard(self,disc_id):
+        with self.lock:
+            e=self.items.pop(disc_id,None)
+            if e: self.used-=e[1]
+
+    def _evict(self,budget):
+        while self.used>budget and len(self.items)>1: _,(_,sz)=self.items.popitem(last=False); self.used-=sz
+
+    def _check_ceiling(self):
+        # Over the ceiling, drop the older half of the cached bodies and images; freed memory is reused before the heap grows
+        if not MEMORY_CEILING_MB or time.monotonic()-self.checked<MEMORY_CHECK_SECS: return
+        self.checked=time.monotonic(); rss=_rss_mb()
+        if rss is None or rss<MEMORY_CEILING_MB: return
+        with self.lock: self._evict(self.used//2)
+        images=get_image_store(); images.shrink(images.used//2)
+        get_metrics().inc("nexus_memory_evictions_total")
+
+    def summary(self):
+        return f" · {len(self.items)} open ({self.used/2**20:.0f} MB)"
+
+@st.cache_resource
+def get_bodies():
+    return BodyCache()
+
+# ─── Process-wide history index for the sidebar ────────────────────
+HISTORY_INDEX_TTL = 60
+
+def _summary(d):
+    return {"id":d.get("id",""),"question":d.get("question",""),"created_at":d.get("created_at") or "",
+            "followup_count":d["followup_count"] if "followup_count" in d else len(d.get("followups",[])),"dt":_parse_dt(d.get("created_at",""))}
+
+class HistoryIndex:
+    # id → summary plus (timestamp, id) pairs kept sorted, so a sidebar page is a bisect and a slice.
+    # Built once per process and patched by save/delete as they are queued; the local store's version
+    # counter (or a TTL for Supabase) tells us when another process has written and the index must be rebuilt.
+    # A rebuild lists storage outside the lock and swaps the result in; a stale index keeps serving meanwhile.
+    def __init__(self):
+        self.lock=threading.RLock(); self.by_id={}; self.order=[]; self.version=0; self.source=None; self.built=0.0
+        self.building=threading.Lock(); self.changes=None   # upserts and removes made while a rebuild was listing
+
+    def _fresh(self):
+        if not self.built: return False
+        if STORAGE_MODE=="local": return self.source is not None and _local_version()==self.source
+        return time.monotonic()-self.built<HISTORY_INDEX_TTL
+
+    def _build(self,wait=True):
+        # Only the first build makes its caller wait; later ones run in the background
+        if not self.building.acquire(blocking=wait): return
+        try:
+            if wait and self.built: return   # another caller finished the first build while we waited
+            with self.lock: self.changes=[]
+            src=_local_version() if STORAGE_MODE=="local" else None; rows,off=[],0
+            while True:
+                page=list_history(0,1000,off); rows+=page; off+=len(page)
+                if len(page)<1000: break
+            by_id={r["id"]:_summary(r) for r in rows}
+            saved,deleted=get_persist_queue().queued()
+            for s in saved: by_id[s["id"]]=s
+            for i in deleted: by_id.pop(i,None)
+            with self.lock:
+                self.by_id,self.order=by_id,sorted((s["dt"],i) for i,s in by_id.items())
+                for disc,disc_id in self.changes:
+                    if disc: self._put(disc)
+                    else: self._drop(disc_id)
+                self.source,self.built=src,time.monotonic(); self.version+=1
+        finally:
+            with self.lock: self.changes=None
+            self.building.release()
+
+    def _drop(self,disc_id):
+        s=self.by_id.pop(disc_id,None)
+        if s:
+            i=bisect.bisect_left(self.order,(s["dt"],disc_id))
+            if i<len(self.order) and self.order[i]==(s["dt"],disc_id): del self.order[i]
+
+    def written(self,ver):
+        # Our own batch only keeps the index current if nobody else wrote in between
+        with self.lock:
+            if ver is not None: self.source=ver if self.source is not None and ver==self.source+1 else None
+
+    def _put(self,disc):
+        self._drop(disc["id"]); s=_summary(disc); self.by_id[s["id"]]=s; bisect.insort(self.order,(s["dt"],s["id"]))
+
+    def upsert(self,disc):
+        with self.lock:
+            if self.changes is not None: self.changes.append((disc,disc["id"]))
+            if self.built: self._put(disc); self.version+=1
+
+    def remove(self,disc_id):
+        with self.lock:
+            if self.changes is not None: self.changes.append((None,disc_id))
+            if self.built: self._drop(disc_id); self.version+=1
+
+    def page(self,days=0,limit=HISTORY_PAGE):
+        if not self.built: self._build()
+        elif not self.building.locked() and not self._fresh(): threading.Thread(target=self._build,args=(False,),name="nexus-history-index",daemon=True).start()
+        with self.lock:
+            lo=bisect.bisect_left(self.order,(datetime.now(timezone.utc).replace(tzinfo=None)-timedelta(days=days),"")) if days>0 else 0
+            return [self.by_id[i] for _,i in reversed(self.order[max(lo,len(self.order)-limit):])]
+
+@st.cache_resource
+def get_history_index():
+    return HistoryIndex()
 
 def _parse_dt(s):
     if not s: return datetime(2000,1,1)
@@ -230,17 +653,13 @@ def _parse_dt(s):
         return dt
     except: return datetime(2000,1,1)
 
-def filter_history(days):
-    history=load_history()
-    if days>0:
-        cutoff=datetime.now(timezone.utc).replace(tzinfo=None)-timedelta(days=days)
-        history=[d for d in history if _parse_dt(d.get("created_at",""))>=cutoff]
-    return sorted(history,key=lambda d:d.get("created_at",""),reverse=True)
+def filter_history(days,pages=1):
+    return get_history_index().page(days,HISTORY_PAGE*pages)
 
 def group_by_date(discs):
     now=datetime.now(timezone.utc).replace(tzinfo=None).date(); groups={"Today":[],"Yesterday":[],"This Week":[],"Older":[]}
     for d in discs:
-        try: ts=_parse_dt(d.get("created_at","")).date()
+        try: ts=(d.get("dt") or _parse_dt(d.get("created_at",""))).date()
         except: ts=now
         delta=(now-ts).days
         if delta==0: groups["Today"].append(d)
@@ -249,84 +668,1263 @@ def group_by_date(discs):
         else: groups["Older"].append(d)
     return groups
 
+PDF_CHAR_BUDGET = 8000
+PDF_CHUNK_PAGES = 8
+PDF_POOL_PAGES  = 40   # documents with at least this many unread pages fan out to the process pool
+PDF_WORKERS     = min(4,os.cpu_count() or 1)
+
+@st.cache_resource
+def _pdf_pool():
+    # Spawned, not forked: forking copies a process that is running the engine loop, persist and job threads
+    import multiprocessing
+    return concurrent.futures.ProcessPoolExecutor(max_workers=PDF_WORKERS,mp_context=multiprocessing.get_context("spawn"))
+
+@st.cache_data(max_entries=64,show_spinner=False)
+def _extract_pdf(digest,_fb):
+    # Keyed on the content hash only; the first chunk is parsed in-process and usually fills the budget
+    texts,total=pdf_extract.page_texts(_fb,0,PDF_CHUNK_PAGES,PDF_CHAR_BUDGET); n=sum(map(len,texts)); start=PDF_CHUNK_PAGES
+    if n<=PDF_CHAR_BUDGET and total-start>=PDF_POOL_PAGES:
+        import tempfile
+        pool=_pdf_pool(); fd,path=tempfile.mkstemp(suffix=".pdf")
+        try:
+            with os.fdopen(fd,"wb") as fh: fh.write(_fb)
+            while start<total and n<=PDF_CHAR_BUDGET:
+                spans=[(a,min(a+PDF_CHUNK_PAGES,total)) for a in range(start,min(total,start+PDF_WORKERS*PDF_CHUNK_PAGES),PDF_CHUNK_PAGES)]
+                for f in [pool.submit(pdf_extract.page_texts,path,a,b,PDF_CHAR_BUDGET) for a,b in spans]:
+                    chunk,_=f.result(); texts+=chunk; n+=sum(map(len,chunk))
+                start=spans[-1][1]
+        finally: os.remove(path)
+    elif n<=PDF_CHAR_BUDGET and start<total:
+        rest,_=pdf_extract.page_texts(_fb,start,None,PDF_CHAR_BUDGET-n); texts+=rest
+    text="\n\n".join(texts).strip()
+    return text[:PDF_CHAR_BUDGET]+("\n[truncated]" if len(text)>PDF_CHAR_BUDGET else "")
+
 def extract_pdf_text(fb):
-    if not PDF_SUPPORT: return "[pdfplumber not installed]"
-    try:
-        with pdfplumber.open(io.BytesIO(fb)) as pdf: text="\n\n".join(p.extract_text() or "" for p in pdf.pages).strip()
-        return text[:8000]+("\n[truncated]" if len(text)>8000 else "")
+    if not _has_module("pdfplumber"): return "[pdfplumber not installed]"
+    try: return _extract_pdf(hashlib.sha256(fb).hexdigest(),fb)
     except Exception as e: return f"[PDF error: {e}]"
 
-def fetch_url_text(url):
+URL_CHAR_BUDGET = 6000
+URL_MAX_BYTES   = 2*1024*1024
+URL_TTL         = 15*60   # served from cache without asking the origin; older entries are revalidated
+
+def _html_to_text(doc):
+    if _has_module("bs4"):
+        from bs4 import BeautifulSoup
+        # lxml is several times faster than html.parser when installed
+        soup=BeautifulSoup(doc,"lxml" if _has_module("lxml") else "html.parser"); [t.decompose() for t in soup(["script","style","nav","footer","header"])]; text=soup.get_text(separator="\n",strip=True)
+    else: text=doc
+    return text[:URL_CHAR_BUDGET]+("\n[truncated]" if len(text)>URL_CHAR_BUDGET else "")
+
+async def afetch_url_text(url):
+    eng=get_engine(); key=hashlib.sha256(url.encode()).hexdigest()
+    hit=await asyncio.to_thread(eng.url_cache.get,key)
+    if hit and time.time()-hit["fetched"]<URL_TTL: return hit["text"]
+    headers={"User-Agent":"Mozilla/5.0"}
+    if hit and hit.get("etag"): headers["If-None-Match"]=hit["etag"]
+    if hit and hit.get("last_modified"): headers["If-Modified-Since"]=hit["last_modified"]
     try:
-        r=requests.get(url,headers={"User-Agent":"Mozilla/5.0"},timeout=15); r.raise_for_status()
-        if BS4_SUPPORT: soup=BeautifulSoup(r.text,"html.parser"); [t.decompose() for t in soup(["script","style","nav","footer","header"])]; text=soup.get_text(separator="\n",strip=True)
-        else: text=r.text
-        return text[:6000]+("\n[truncated]" if len(text)>6000 else "")
-    except Exception as e: return f"[URL error: {e}]"
+        async with eng.web().stream("GET",url,headers=headers) as r:
+            if r.status_code==304 and hit: text=hit["text"]
+            else:
+                r.raise_for_status(); buf=bytearray()
+                async for chunk in r.aiter_bytes():
+                    buf+=chunk
+                    if len(buf)>=URL_MAX_BYTES: break
+                text=await asyncio.to_thread(_html_to_text,bytes(buf[:URL_MAX_BYTES]).decode(r.charset_encoding or "utf-8",errors="replace"))
+            entry={"text":text,"fetched":time.time(),"etag":r.headers.get("etag") or (hit or {}).get("etag"),
+                   "last_modified":r.headers.get("last-modified") or (hit or {}).get("last_modified")}
+        await asyncio.to_thread(eng.url_cache.put,key,entry)
+        return text
+    except Exception as e: return hit["text"] if hit else f"[URL error: {e}]"   # a stale copy beats no context when revalidation fails
+
+def fetch_urls(urls):
+    async def all_(): return await asyncio.gather(*(afetch_url_text(u) for u in urls))
+    return get_engine().run(all_())
+
+# ─── Token budgets: keep every prompt bounded however long a discussion runs ───
+TOKEN_RATIO = {"anthropic":3.5,"openai":4.0,"gemini":4.0,"perplexity":4.0,"deepseek":3.8}   # characters per token
+PERSONA_PROVIDER = {"claude":"anthropic","gemini":"gemini","gpt4":"openai","perplexity":"perplexity","deepseek":"deepseek"}
+PHASE_BUDGETS = {"context":5000,"debate":6000,"synthesis":12000,"followup":6000,"followup_history":2500}
+FOLLOWUPS_VERBATIM = 2
+SUMMARY_SYSTEM = "You maintain a running summary of an ongoing multi-AI discussion. Merge the new exchanges into the existing summary. Keep conclusions, key facts and figures, disagreements and open questions. Dense prose, under 250 words."
+
+def count_tokens(text,provider="anthropic"):
+    return math.ceil(len(text)/TOKEN_RATIO.get(provider,4.0))
+
+def _clip(text,chars):
+    if len(text)<=chars: return text
+    cut=text[:chars]; end=max(cut.rfind(". "),cut.rfind("\n"))
+    return (cut[:end+1] if end>chars*0.6 else cut).rstrip()+" […]"
+
+def fit_sections(sections,budget,provider="anthropic"):
+    # Water-fill: short sections stay whole, the longest are clipped to a common cap until the total fits
+    limit=int(budget*TOKEN_RATIO.get(provider,4.0)); lens=sorted(len(s) for s in sections)
+    if sum(lens)<=limit: return list(sections)
+    left,n,cap=limit,len(lens),0
+    for i,l in enumerate(lens):
+        cap=left//(n-i)
+        if l>cap: break
+        left-=l
+    return [_clip(s,cap) for s in sections]
+
+def _qa(fu,i): return f"Q{i+1}: {fu['question']}\nA: {fu.get('synthesis','')}\n\n"
+
+def compact_followups(followups,summary=None,spec=None):
+    # Fold the oldest follow-ups into the rolling summary until the verbatim tail fits its budget.
+    # Only newly folded exchanges are sent to the summarizer, so the cost per follow-up stays flat.
+    summary=summary or {"text":"","upto":0}; fold=summary["upto"]
+    while len(followups)-fold>FOLLOWUPS_VERBATIM and count_tokens("".join(_qa(fu,i) for i,fu in enumerate(followups) if i>=fold))>PHASE_BUDGETS["followup_history"]: fold+=1
+    if fold==summary["upto"]: return summary
+    new="".join(_qa(followups[i],i) for i in range(summary["upto"],fold))
+    try: text=call_claude(SUMMARY_SYSTEM,(f"RUNNING SUMMARY:\n{summary['text']}\n\n" if summary["text"] else "")+f"NEW EXCHANGES:\n{new}\nUpdated summary:",spec=spec or model_spec("summary"))
+    except Exception: return summary
+    return {"text":text,"upto":fold}
+
+def followup_history(q,synthesis,followups,summary=None):
+    # Returned as cacheable segments, most stable first: the original question and synthesis never change,
+    # the summary changes only when older exchanges are folded, and the verbatim tail grows each turn
+    summary=summary or {"text":"","upto":0}; tail=followups[summary["upto"]:]
+    prior=fit_sections([_qa(fu,summary["upto"]+i) for i,fu in enumerate(tail)],PHASE_BUDGETS["followup_history"]) if tail else []
+    segs=[{"text":f'ORIGINAL: "{q}"\n\nSYNTHESIS:\n{_clip(synthesis,PHASE_BUDGETS["followup"]*2)}\n\n',"cache":True}]
+    if summary["text"]: segs.append({"text":f"EARLIER (summary):\n{summary['text']}\n\n","cache":True})
+    if prior: segs.append({"text":"PRIOR:\n"+"".join(prior),"cache":True})
+    return segs
 
 def build_text_context(items):
     if not items: return ""
-    return "[ADDITIONAL CONTEXT]\n"+"".join(f"\n--- {i['label']} ---\n{i['content']}" for i in items)+"\n[END CONTEXT]\n\n"
-
-def call_claude(system,message,image_data=None):
-    client=anthropic.Anthropic(api_key=ANTHROPIC_KEY)
-    if image_data: content=[{"type":"image","source":{"type":"base64","media_type":img["media_type"],"data":img["data"]}} for img in image_data]; content.append({"type":"text","text":message})
-    else: content=message
-    resp=client.messages.create(model="claude-opus-4-5-20251101",max_tokens=1000,system=system,messages=[{"role":"user","content":content}])
-    return resp.content[0].text
-
-def call_gemini(system,message,image_data=None):
-    if not GEMINI_KEY: raise ValueError()
-    parts=([{"inline_data":{"mime_type":img["media_type"],"data":img["data"]}} for img in image_data] if image_data else []); parts.append({"text":message})
-    r=requests.post(f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent?key={GEMINI_KEY}",json={"system_instruction":{"parts":[{"text":system}]},"contents":[{"parts":parts}]},timeout=60)
-    r.raise_for_status(); return r.json()["candidates"][0]["content"]["parts"][0]["text"]
-
-def call_openai_compat(api_key,base_url,model,system,message,image_data=None):
-    if image_data: content=[{"type":"image_url","image_url":{"url":f"data:{img['media_type']};base64,{img['data']}"}} for img in image_data]; content.append({"type":"text","text":message})
-    else: content=message
-    r=requests.post(f"{base_url}/chat/completions",json={"model":model,"messages":[{"role":"system","content":system},{"role":"user","content":content}],"max_tokens":1000},
-                    headers={"Authorization":f"Bearer {api_key}","Content-Type":"application/json"},timeout=60)
-    r.raise_for_status(); return r.json()["choices"][0]["message"]["content"]
-
-def call_perplexity(system,message,image_data=None):
-    if not PERPLEXITY_KEY: raise ValueError()
-    r=requests.post("https://api.perplexity.ai/chat/completions",json={"model":"llama-3.1-sonar-small-128k-online","messages":[{"role":"system","content":system},{"role":"user","content":message}]},
-                    headers={"Authorization":f"Bearer {PERPLEXITY_KEY}","Content-Type":"application/json"},timeout=60)
-    r.raise_for_status(); return r.json()["choices"][0]["message"]["content"]
-
-def call_persona(persona,prompt_type,message,image_data=None):
-    system=PERSONAS[persona][prompt_type]
+    contents=fit_sections([i["content"] for i in items],PHASE_BUDGETS["context"])
+    return "[ADDITIONAL CONTEXT]\n"+"".join(f"\n--- {i['label']} ---\n{c}" for i,c in zip(items,contents))+"\n[END CONTEXT]\n\n"
+
+# ─── Per-provider quotas shared by every session in the process ─────
+RATE_LIMITS = {
+    "anthropic":  {"rpm":50, "tpm":80000,  "concurrency":10},
+    "gemini":     {"rpm":60, "tpm":1000000,"concurrency":10},
+    "openai":     {"rpm":500,"tpm":30000,  "concurrency":16},
+    "perplexity": {"rpm":50, "tpm":200000, "concurrency":10},
+    "deepseek":   {"rpm":60, "tpm":500000, "concurrency":10},
+}
+RATE_LIMIT_RETRIES = 3
+_SESSION = contextvars.ContextVar("nexus_session",default="anon")
+_TRACE = contextvars.ContextVar("nexus_trace",default=None)   # {"phase":..., "calls":[...]} collecting the current step's call records
+_ON_SEND = contextvars.ContextVar("nexus_on_send",default=None)   # told True when a request goes out, False when it waits on quota again
+
+class ProviderLimiter:
+    # Token buckets for requests/min and tokens/min plus a concurrency cap; waiters are
+    # granted round-robin across sessions so one busy discussion cannot starve the rest
+    def __init__(self,rpm,tpm,concurrency):
+        self.rpm,self.tpm,self.concurrency=rpm,tpm,concurrency
+        self.req_left,self.tok_left,self.stamp=float(rpm),float(tpm),time.monotonic()
+        self.inflight,self.blocked_until,self.waiters,self._timer=0,0.0,collections.OrderedDict(),None
+
+    async def acquire(self,sid,cost):
+        fut=asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(sid,collections.deque()).append((min(cost,self.tpm),fut)); self._grant()
+        try: await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled(): self.release()
+            raise
+
+    def release(self):
+        self.inflight-=1; self._grant()
+
+    def penalize(self,seconds):
+        self.blocked_until=max(self.blocked_until,time.monotonic()+seconds); self._grant()
+
+    def queued(self):
+        return sum(len(dq) for dq in self.waiters.values())
+
+    def _grant(self):
+        if self._timer: self._timer.cancel(); self._timer=None
+        now=time.monotonic(); el=now-self.stamp; self.stamp=now
+        self.req_left=min(self.rpm,self.req_left+el*self.rpm/60); self.tok_left=min(self.tpm,self.tok_left+el*self.tpm/60)
+        wait=self.blocked_until-now
+        while wait<=0 and self.waiters and self.inflight<self.concurrency:
+            sid,dq=next(iter(self.waiters.items())); cost,fut=dq[0]
+            if fut.done(): dq.popleft()
+            elif self.req_left<1 or self.tok_left<cost: wait=max((1-self.req_left)*60/self.rpm,(cost-self.tok_left)*60/self.tpm); break
+            else: self.req_left-=1; self.tok_left-=cost; self.inflight+=1; dq.popleft(); fut.set_result(None)
+            if not dq: del self.waiters[sid]
+            else: self.waiters.move_to_end(sid)
+        if wait>0 and self.waiters: self._timer=asyncio.get_running_loop().call_later(wait,self._grant)
+
+# ─── Deadlines, hedging and circuit breaking for non-Claude personas ───
+PROVIDER_DEADLINES = {"gemini":30.0,"openai":30.0,"perplexity":30.0,"deepseek":40.0}   # s to first token, and between tokens
+HEDGE = {"quantile":0.95,"min":3.0,"max":15.0,"default":8.0,"samples":10}   # Claude hedge launches at this first-token cutoff
+BREAKER = {"failures":3,"cooldown":60.0}
+
+class CircuitBreaker:
+    # Opens after consecutive failures; once the cool-down passes a single trial call decides whether it closes again
+    def __init__(self,failures,cooldown):
+        self.threshold,self.cooldown=failures,cooldown
+        self.failures,self.opened,self.trial,self.last_error=0,0.0,False,""
+
+    def allow(self):
+        if self.failures<self.threshold: return True
+        if self.trial or time.monotonic()-self.opened<self.cooldown: return False
+        self.trial=True; return True
+
+    def success(self):
+        self.failures,self.trial=0,False
+
+    def failure(self,reason):
+        self.failures+=1; self.trial=False; self.last_error=reason
+        if self.failures>=self.threshold: self.opened=time.monotonic()
+
+    def settle(self):
+        # A trial call that was cancelled before it decided anything frees the slot for the next one
+        self.trial=False
+
+    def state(self):
+        if self.failures<self.threshold: return "closed"
+        return "half-open" if self.trial or time.monotonic()-self.opened>=self.cooldown else "open"
+
+# ─── Content-addressed response cache ──────────────────────────────
+CACHE_DIR = os.path.join(DATA_DIR, "nexus_cache")
+CACHE_MEM_ITEMS = 512
+CACHE_DISK_BYTES = 256*1024*1024
+CACHE_TTL = 7*24*3600
+
+class ResponseCache:
+    # In-memory LRU in front of one JSON file per key on disk; disk is trimmed oldest-first past its byte budget
+    def __init__(self,path=CACHE_DIR,mem_items=CACHE_MEM_ITEMS,disk_bytes=CACHE_DISK_BYTES,ttl=CACHE_TTL):
+        self.path,self.mem_items,self.disk_bytes,self.ttl=path,mem_items,disk_bytes,ttl
+        self.mem=collections.OrderedDict(); self.lock=threading.Lock(); self.stats=collections.Counter()
+        try: os.makedirs(path,exist_ok=True); self.disk_used=sum(e.stat().st_size for e in os.scandir(path) if e.is_file())
+        except OSError: self.disk_used=0
+
+    def _file(self,key): return os.path.join(self.path,f"{key}.json")
+
+    def _remember(self,key,t,value):
+        with self.lock:
+            self.mem[key]=(t,value); self.mem.move_to_end(key)
+            while len(self.mem)>self.mem_items: self.mem.popitem(last=False)
+
+    def get(self,key):
+        with self.lock:
+            hit=self.mem.get(key)
+            if hit and time.time()-hit[0]<self.ttl: self.mem.move_to_end(key); self.stats["mem_hits"]+=1; return hit[1]
+        f=self._file(key)
+        try:
+            with open(f,encoding="utf-8") as fh: e=json.load(fh)
+            if time.time()-e["t"]<self.ttl: self._remember(key,e["t"],e["v"]); os.utime(f); self.stats["disk_hits"]+=1; return e["v"]
+            os.remove(f)
+        except (OSError,ValueError,KeyError): pass
+        self.stats["misses"]+=1; return None
+
+    def put(self,key,value):
+        t=time.time(); self._remember(key,t,value); f=self._file(key); tmp=f"{f}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp,"w",encoding="utf-8") as fh: json.dump({"t":t,"v":value},fh,ensure_ascii=False)
+            try: old=os.path.getsize(f)   # an overwrite replaces this many bytes rather than adding to them
+            except OSError: old=0
+            os.replace(tmp,f); self.disk_used+=os.path.getsize(f)-old; self.stats["writes"]+=1
+        except OSError: return
+        if self.disk_used>self.disk_bytes: self._evict()
+
+    def _evict(self):
+        with self.lock:
+            try: files=sorted((e.stat().st_mtime,e.stat().st_size,e.path) for e in os.scandir(self.path) if e.is_file())
+            except OSError: return
+            used=sum(sz for _,sz,_ in files)
+            for _,sz,path in files:
+                if used<=self.disk_bytes*0.9: break
+                try: os.remove(path); used-=sz; self.stats["evictions"]+=1
+                except OSError: pass
+            self.disk_used=used
+
+    def summary(self):
+        hits=self.stats["mem_hits"]+self.stats["disk_hits"]; total=hits+self.stats["misses"]
+        return f"Cache {hits}/{total} hits" if total else "Cache empty"
+
+# ─── Telemetry: process-wide counters and histograms, scraped in Prometheus text format ───
+METRICS_PORT = get_secret("NEXUS_METRICS_PORT")   # serve /metrics on this port when set
+LATENCY_BUCKETS = (0.1,0.25,0.5,1,2.5,5,10,20,30,60,120)
+CALL_FIELDS = ("provider","model","outcome","wall","ttft","input_tokens","output_tokens","cached_tokens","req_bytes","resp_bytes","retries","fallback")
+
+def _labels(labels): return tuple(sorted((labels or {}).items()))
+
+class Metrics:
+    def __init__(self):
+        self.lock=threading.Lock(); self.counters=collections.defaultdict(float); self.gauges=collections.defaultdict(float); self.hists={}; self.endpoint=None
+
+    def inc(self,name,labels=None,v=1.0):
+        with self.lock: self.counters[(name,_labels(labels))]+=v
+
+    def add(self,name,labels=None,v=1.0):
+        with self.lock: self.gauges[(name,_labels(labels))]+=v
+
+    def observe(self,name,v,labels=None,buckets=LATENCY_BUCKETS):
+        with self.lock:
+            h=self.hists.get((name,_labels(labels)))
+            if h is None: h=self.hists[(name,_labels(labels))]={"buckets":buckets,"counts":[0]*len(buckets),"sum":0.0,"n":0}
+            for i,b in enumerate(buckets):
+                if v<=b: h["counts"][i]+=1
+            h["sum"]+=v; h["n"]+=1
+
+    def observe_call(self,rec):
+        p={"provider":rec["provider"]}
+        self.inc("nexus_provider_calls_total",{**p,"outcome":rec["outcome"]})
+        if rec["outcome"]=="ok":
+            self.observe("nexus_provider_call_seconds",rec["wall"],p)
+            if rec["ttft"] is not None: self.observe("nexus_provider_ttft_seconds",rec["ttft"],p)
+        for kind in ("input","output","cached"):
+            if rec.get(f"{kind}_tokens"): self.inc("nexus_provider_tokens_total",{**p,"kind":kind},rec[f"{kind}_tokens"])
+        self.inc("nexus_provider_bytes_total",{**p,"direction":"sent"},rec["req_bytes"]); self.inc("nexus_provider_bytes_total",{**p,"direction":"received"},rec["resp_bytes"])
+        if rec.get("retries"): self.inc("nexus_provider_retries_total",p,rec["retries"])
+        if rec["fallback"]: self.inc("nexus_fallback_calls_total",p)
+
+    def render(self,gauges=()):
+        with self.lock: counters,gs,hists=dict(self.counters),dict(self.gauges),copy.deepcopy(self.hists)
+        for name,labels,v in gauges: gs[(name,_labels(labels))]=v
+        def fmt(name,lab,extra=()):
+            lab=list(lab)+list(extra)
+            return name+("{"+",".join('%s="%s"'%(k,str(v).replace("\\","\\\\").replace('"','\\"')) for k,v in lab)+"}" if lab else "")
+        out=[]
+        for kind,series in (("counter",counters),("gauge",gs)):
+            for name in sorted({n for n,_ in series}):
+                out.append(f"# TYPE {name} {kind}"); out+=[f"{fmt(name,lab)} {v:g}" for (n,lab),v in sorted(series.items()) if n==name]
+        for name in sorted({n for n,_ in hists}):
+            out.append(f"# TYPE {name} histogram")
+            for (n,lab),h in sorted(hists.items()):
+                if n!=name: continue
+                out+=[f"{fmt(name+'_bucket',lab,[('le',f'{b:g}')])} {c}" for b,c in zip(h["buckets"],h["counts"])]
+                out+=[f"{fmt(name+'_bucket',lab,[('le','+Inf')])} {h['n']}",f"{fmt(name+'_sum',lab)} {h['sum']:g}",f"{fmt(name+'_count',lab)} {h['n']}"]
+        return "\n".join(out)+"\n"
+
+def _scrape_gauges():
+    # Limiter state is owned by the engine loop, so read it there
+    eng=get_engine()
+    async def read():
+        out=[]
+        for p,lim in eng._limiters.items(): out+=[("nexus_limiter_inflight",{"provider":p},lim.inflight),("nexus_limiter_queued",{"provider":p},lim.queued())]
+        for p,b in eng._breakers.items(): out.append(("nexus_breaker_open",{"provider":p},int(b.state()!="closed")))
+        return out
+    cs=eng.cache.stats
+    return eng.run(read(),timeout=5)+[("nexus_response_cache_hits",None,cs["mem_hits"]+cs["disk_hits"]),("nexus_response_cache_misses",None,cs["misses"]),
+                                      ("nexus_persist_backlog",None,get_persist_queue().depth()),("nexus_body_cache_bytes",None,get_bodies().used),
+                                      ("nexus_image_store_bytes",None,get_image_store().used)]+[("nexus_startup_seconds",{"stage":k[:-2]},v) for k,v in _startup().items() if v is not None]
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/","/metrics"): self.send_error(404); return
+        body=get_metrics().render(_scrape_gauges()).encode()
+        self.send_response(200); self.send_header("Content-Type","text/plain; version=0.0.4"); self.send_header("Content-Length",str(len(body))); self.end_headers(); self.wfile.write(body)
+
+    def log_message(self,*args): pass
+
+@st.cache_resource
+def get_metrics():
+    m=Metrics()
+    if METRICS_PORT:
+        try:
+            srv=http.server.ThreadingHTTPServer(("0.0.0.0",int(METRICS_PORT)),_MetricsHandler); srv.daemon_threads=True
+            threading.Thread(target=srv.serve_forever,name="nexus-metrics",daemon=True).start(); m.endpoint=f":{METRICS_PORT}/metrics"
+        except (OSError,ValueError) as e: m.endpoint=f"unavailable ({e})"
+    return m
+
+# ─── Async provider engine: one event loop and pooled clients per process ───
+class ProviderEngine:
+    def __init__(self):
+        self.loop=asyncio.new_event_loop(); self._http={}; self._claude=None; self._limiters={}; self._web=None
+        self.calls=collections.deque(maxlen=2000)   # recent per-call usage records, including prompt-cache hits
+        self._breakers={}; self.ttft=collections.defaultdict(lambda:collections.deque(maxlen=200)); self.metrics=get_metrics()
+        self.cache=ResponseCache(); self.url_cache=ResponseCache(os.path.join(CACHE_DIR,"urls"),mem_items=128,disk_bytes=64*1024*1024)
+        threading.Thread(target=self.loop.run_forever,name="nexus-engine",daemon=True).start()
+
+    def http(self,base_url):
+        # One keep-alive pool per provider base URL, reused by every session and rerun
+        c=self._http.get(base_url)
+        if c is None:
+            import httpx
+            c=self._http[base_url]=httpx.AsyncClient(base_url=base_url,timeout=httpx.Timeout(60,connect=10),limits=httpx.Limits(max_connections=64,max_keepalive_connections=16,keepalive_expiry=120))
+        return c
+
+    def web(self):
+        # Shared client for user-supplied context URLs
+        if self._web is None:
+            import httpx
+            self._web=httpx.AsyncClient(timeout=httpx.Timeout(15,connect=10),follow_redirects=True,limits=httpx.Limits(max_connections=32,max_keepalive_connections=8))
+        return self._web
+
+    def claude(self):
+        # Retries are left to the scheduler so Retry-After is honoured process-wide
+        if self._claude is None:
+            import anthropic
+            self._claude=anthropic.AsyncAnthropic(api_key=ANTHROPIC_KEY,base_url=PROVIDER_URLS["anthropic"],timeout=60,max_retries=0)
+        return self._claude
+
+    def limiter(self,provider):
+        lim=self._limiters.get(provider)
+        if lim is None: lim=self._limiters[provider]=ProviderLimiter(**RATE_LIMITS[provider])
+        return lim
+
+    def breaker(self,provider):
+        b=self._breakers.get(provider)
+        if b is None: b=self._breakers[provider]=CircuitBreaker(**BREAKER)
+        return b
+
+    def hedge_after(self,provider):
+        # A high percentile of the provider's recent time-to-first-token, so only its slow tail gets hedged
+        obs=sorted(self.ttft[provider])
+        if len(obs)<HEDGE["samples"]: return HEDGE["default"]
+        return min(HEDGE["max"],max(HEDGE["min"],obs[int(len(obs)*HEDGE["quantile"])]))
+
+    def prompt_cache_summary(self):
+        calls=[c for c in list(self.calls) if c.get("input_tokens")]
+        if not calls: return ""
+        # Anthropic reports cache reads and writes outside input_tokens; the others count them inside prompt tokens
+        cached=sum(c.get("cached_tokens",0) for c in calls)
+        total=sum(c["input_tokens"]+(c.get("cached_tokens",0)+c.get("cache_write_tokens",0) if c["provider"]=="anthropic" else 0) for c in calls)
+        return f" · Prompt cache {cached*100//max(total,1)}% of input"
+
+    def submit(self,coro):
+        # Tasks on the loop don't inherit the caller's context, so carry the session and trace across explicitly
+        sid,trace=_SESSION.get(),_TRACE.get()
+        async def in_session(): _SESSION.set(sid); _TRACE.set(trace); return await coro
+        return asyncio.run_coroutine_threadsafe(in_session(),self.loop)
+
+    def run(self,coro,timeout=None):
+        fut=self.submit(coro)
+        try: return fut.result(timeout)
+        except BaseException: fut.cancel(); raise
+
+    def iterate(self,agen):
+        # Bridge an async generator on the engine loop to a plain iterator on the calling thread
+        q=queue.Queue(); done=object()
+        async def pump():
+            try:
+                async for d in agen: q.put((d,None))
+            except Exception as e: q.put((None,e))
+            finally: q.put((done,None))
+        fut=self.submit(pump())
+        try:
+            while True:
+                d,err=q.get()
+                if err is not None: raise err
+                if d is done: return
+                yield d
+        finally: fut.cancel()
+
+@st.cache_resource
+def get_engine():
+    return ProviderEngine()
+
+# ─── Image ingestion: hash once, downscale per provider, share the encoded payload ───
+IMAGE_LIMITS = {"anthropic":(1568,None),"openai":(2048,768),"gemini":(3072,None)}   # (long edge, short edge) in px
+IMAGE_STORE_BYTES = 256*1024*1024
+IMAGE_DIR = os.path.join(DATA_DIR, "nexus_images")   # raw uploads by hash, so a resumed job still has its images
+IMAGE_DISK_BYTES = 512*1024*1024
+IMAGE_DISK_TTL = 7*24*3600   # uploads of abandoned, failed or never-submitted jobs are swept at startup past either cap
+
+def _encode_image(fb,media_type,long_edge,short_edge=None):
+    # Downscale to what the provider actually uses and re-encode compactly; the original wins if it's already smaller
+    try:
+        from PIL import Image,ImageOps
+        im=ImageOps.exif_transpose(Image.open(io.BytesIO(fb))); w,h=im.size
+        scale=min(1.0,long_edge/max(w,h),short_edge/min(w,h) if short_edge else 1.0)
+        if scale<1: im=im.resize((max(1,round(w*scale)),max(1,round(h*scale))),Image.LANCZOS)
+        out=io.BytesIO()
+        if im.mode in ("RGBA","LA") or (im.mode=="P" and "transparency" in im.info): im.convert("RGBA").save(out,"WEBP",quality=80,method=4); mt="image/webp"
+        else: im.convert("RGB").save(out,"JPEG",quality=85,optimize=True,progressive=True); mt="image/jpeg"
+        if scale<1 or out.tell()<len(fb): return mt,base64.b64encode(out.getvalue()).decode()
+    except Exception: pass
+    return media_type,base64.b64encode(fb).decode()
+
+class ImageStore:
+    # Raw uploads keyed by content hash plus their per-provider encodings, in one byte-budgeted LRU.
+    # Every request in a fan-out gets the same encoded string object rather than its own copy.
+    # Raw bytes are also written to disk until the jobs using them finish; memory only holds a cached copy.
+    def __init__(self,max_bytes=IMAGE_STORE_BYTES,path=IMAGE_DIR,disk_bytes=IMAGE_DISK_BYTES,disk_ttl=IMAGE_DISK_TTL):
+        self.max_bytes,self.path=max_bytes,path; self.items=collections.OrderedDict(); self.used=0; self.lock=threading.Lock(); self.busy={}
+        self.pinned=collections.Counter()   # hashes that queued or running jobs still have to send
+        self._sweep(disk_bytes,disk_ttl)
+
+    def _file(self,h): return os.path.join(self.path,h)
+
+    def _sweep(self,disk_bytes,disk_ttl):
+        # Oldest first: everything past the TTL, then whatever still goes over the disk budget
+        try: files=sorted((e.stat().st_mtime,e.stat().st_size,e.path) for e in os.scandir(self.path) if e.is_file())
+        except OSError: return
+        used=sum(sz for _,sz,_ in files); now=time.time()
+        for mtime,sz,path in files:
+            if now-mtime<disk_ttl and used<=disk_bytes: break
+            try: os.remove(path); used-=sz
+            except OSError: pass
+
+    def _get(self,key):
+        with self.lock:
+            e=self.items.get(key)
+            if e: self.items.move_to_end(key); return e[0]
+
+    def _put(self,key,value,size):
+        with self.lock:
+            if key in self.items: self.used-=self.items[key][1]
+            self.items[key]=(value,size); self.items.move_to_end(key); self.used+=size
+            self._evict(self.max_bytes)
+
+    def _evict(self,budget):
+        # Oldest first, but never an image a live job is about to send
+        for key in [k for k in self.items if k[1] not in self.pinned]:
+            if self.used<=budget or len(self.items)<=1: break
+            self.used-=self.items.pop(key)[1]
+
+    def pin(self,hashes):
+        with self.lock: self.pinned.update(hashes)
+
+    def unpin(self,hashes):
+        with self.lock: self.pinned.subtract(hashes); self.pinned+=collections.Counter()   # drops the zero counts
+
+    def shrink(self,budget):
+        with self.lock: self._evict(budget)
+
+    def add(self,fb,media_type):
+        h=hashlib.sha256(fb).hexdigest(); f=self._file(h)
+        if self._get(("raw",h)) is None: self._put(("raw",h),(fb,media_type),len(fb))
+        try:
+            if os.path.exists(f): os.utime(f)   # a re-upload restarts the file's age
+            else:
+                os.makedirs(self.path,exist_ok=True); tmp=f"{f}.{uuid.uuid4().hex}.tmp"
+                with open(tmp,"wb") as fh: fh.write(fb)
+                os.replace(tmp,f)
+        except OSError: pass
+        return h
+
+    def has(self,h): return self._get(("raw",h)) is not None or os.path.exists(self._file(h))
+
+    def _raw(self,h,media_type):
+        raw=self._get(("raw",h))
+        if raw is None:
+            try:
+                with open(self._file(h),"rb") as fh: raw=(fh.read(),media_type)
+            except OSError: return None
+            self._put(("raw",h),raw,len(raw[0]))
+        return raw
+
+    def discard(self,hashes):
+        # Drops the disk copies once no job needs them; the in-memory copies age out of the LRU as usual
+        for h in hashes:
+            try: os.remove(self._file(h))
+            except OSError: pass
+
+    def payload(self,h,provider,media_type=None):
+        key=(provider,h)
+        with self.busy.setdefault(key,threading.Lock()):
+            try:
+                hit=self._get(key)
+                if hit is None:
+                    raw=self._raw(h,media_type)
+                    if raw is None: return None
+                    hit=_encode_image(*raw,*IMAGE_LIMITS.get(provider,IMAGE_LIMITS["anthropic"])); self._put(key,hit,len(hit[1]))
+                return hit
+            finally: self.busy.pop(key,None)   # only concurrent first requests need the lock; later ones hit the cache
+
+@st.cache_resource
+def get_image_store():
+    return ImageStore()
+
+async def _image_payloads(image_data,provider):
+    store=get_image_store(); out=[await asyncio.to_thread(store.payload,img["hash"],provider,img.get("media_type")) for img in image_data or []]
+    return [p for p in out if p]
+
+# ─── Model tiers: which model and output budget each persona gets in each phase ───
+MODELS = {
+    "anthropic":  {"large":"claude-opus-4-5-20251101","small":"claude-haiku-4-5-20251001"},
+    "gemini":     {"large":"gemini-1.5-flash","small":"gemini-1.5-flash-8b"},
+    "openai":     {"large":"gpt-4o","small":"gpt-4o-mini"},
+    "perplexity": {"large":"llama-3.1-sonar-small-128k-online","small":"llama-3.1-sonar-small-128k-online"},
+    "deepseek":   {"large":"deepseek-chat","small":"deepseek-chat"},
+}
+# profile → phase → persona ("*" = any) → (tier, max output tokens). Fast keeps the large model for synthesis only.
+TIER_PROFILES = {
+    "quality": {"initial":{"*":("large",1000)},"debate":{"*":("large",1000)},"followup":{"*":("large",1000)},"synthesis":{"*":("large",1000)},"factcheck":{"*":("large",1000)},"summary":{"*":("large",1000)}},
+    "fast":    {"initial":{"*":("small",600)}, "debate":{"*":("small",500)}, "followup":{"*":("small",600)}, "synthesis":{"*":("large",1000)},"factcheck":{"*":("small",600)},"summary":{"*":("small",600)}},
+}
+DEFAULT_PROFILE = "quality"
+DEFAULT_SPEC = ("large",1000)
+
+def model_spec(phase,profile=DEFAULT_PROFILE,persona="*"):
+    table=TIER_PROFILES.get(profile,TIER_PROFILES[DEFAULT_PROFILE]).get(phase,{})
+    return table.get(persona) or table.get("*") or DEFAULT_SPEC
+
+# ─── Provider adapters: async generators yielding text deltas ──────
+# Messages are either a plain string or a list of segments {"text":..., "cache":bool}. Segments put the
+# material shared by several calls first, so providers that cache prompt prefixes can reuse it.
+def msg_text(message):
+    return message if isinstance(message,str) else "".join(seg["text"] for seg in message)
+
+def _est_tokens(system,message,max_tokens=1000):
+    return (len(system)+len(msg_text(message)))//4+max_tokens
+
+def _retry_after(e,attempt):
+    # Seconds to back off for a rate-limit/overload response, or None if the error isn't retryable
+    resp=getattr(e,"response",None)
+    if resp is None or resp.status_code not in (429,503,529): return None
+    ra=resp.headers.get("retry-after")
+    if ra:
+        try: return max(0.0,float(ra))
+        except ValueError:
+            try: return max(0.0,email.utils.parsedate_to_datetime(ra).timestamp()-time.time())
+            except Exception: pass
+    return min(30.0,2.0**attempt)
+
+def _status_errors():
+    # Only evaluated once an exception is raised, by which point a client has imported both libraries
+    import httpx,anthropic
+    return (httpx.HTTPStatusError,anthropic.APIStatusError)
+
+async def _scheduled(provider,cost,request,usage):
+    lim=get_engine().limiter(provider); sid=_SESSION.get(); on_send=_ON_SEND.get()
+    for attempt in range(RATE_LIMIT_RETRIES+1):
+        if attempt and on_send: on_send(False)
+        await lim.acquire(sid,cost); started=False; usage["retries"]=attempt
+        if on_send: on_send(True)
+        try:
+            async for d in request(usage): started=True; yield d
+            return
+        except _status_errors() as e:
+            wait=_retry_after(e,attempt)
+            if wait is None or started or attempt==RATE_LIMIT_RETRIES: raise
+            lim.penalize(wait)
+        finally: lim.release()
+
+def cache_key(provider,model,system,message,image_data=None,max_tokens=1000):
+    imgs=[img["hash"] for img in image_data or []]
+    return hashlib.sha256(json.dumps([provider,model,system,message,imgs,max_tokens],ensure_ascii=False).encode()).hexdigest()
+
+async def _dispatch(provider,model,system,message,image_data,max_tokens,request,fallback=None):
+    # Cache sits in front of the scheduler: a hit costs no quota and returns in one delta.
+    # Every call, including hits, failures and cancelled hedges, leaves one telemetry record.
+    eng=get_engine(); key=cache_key(provider,model,system,message,image_data,max_tokens); trace=_TRACE.get()
+    rec={"t":time.time(),"provider":provider,"model":model,"phase":trace and trace["phase"],"fallback":fallback,"ttft":None,
+         "req_bytes":len(system.encode())+len(msg_text(message).encode())+sum(img.get("size",0) for img in image_data or [])}
+    t0=time.monotonic(); text,usage,outcome="",{},"error"
+    try:
+        hit=await asyncio.to_thread(eng.cache.get,key)
+        if hit is not None:
+            outcome,text,rec["ttft"]="cached",hit,time.monotonic()-t0; yield hit; return
+        async for d in _scheduled(provider,_est_tokens(system,message,max_tokens or 1000),request,usage):
+            if not text: rec["ttft"]=time.monotonic()-t0
+            text+=d; yield d
+        outcome="ok"
+        if text: await asyncio.to_thread(eng.cache.put,key,text)
+    except (asyncio.CancelledError,GeneratorExit): outcome="cancelled"; raise
+    finally:
+        rec.update(usage,outcome=outcome,wall=time.monotonic()-t0,resp_bytes=len(text.encode()))
+        eng.calls.append(rec); eng.metrics.observe_call(rec)
+        if trace is not None: trace["calls"].append(rec)
+
+async def _sse_events(r):
+    async for line in r.aiter_lines():
+        if line.startswith("data:"):
+            d=line[5:].strip()
+            if d and d!="[DONE]": yield json.loads(d)
+
+def _chat_usage(u):
+    # OpenAI reports cached prompt tokens under prompt_tokens_details, DeepSeek as prompt_cache_hit_tokens
+    return {"input_tokens":u.get("prompt_tokens",0),"output_tokens":u.get("completion_tokens",0),
+            "cached_tokens":(u.get("prompt_tokens_details") or {}).get("cached_tokens") or u.get("prompt_cache_hit_tokens") or 0}
+
+async def _astream_chat(provider,base_url,api_key,payload,system,message,image_data=None):
+    async def request(usage):
+        async with get_engine().http(base_url).stream("POST","/chat/completions",json={**payload,"stream":True},headers={"Authorization":f"Bearer {api_key}"}) as r:
+            r.raise_for_status()
+            async for ev in _sse_events(r):
+                if ev.get("usage"): usage.update(_chat_usage(ev["usage"]))
+                d=(ev.get("choices") or [{}])[0].get("delta",{}).get("content")
+                if d: yield d
+    async for d in _dispatch(provider,payload["model"],system,message,image_data,payload.get("max_tokens"),request): yield d
+
+CLAUDE_SHARED_SYSTEM = "You are one voice in a multi-AI discussion. The shared material comes first in the user message; your role instructions follow it under [YOUR ROLE]. Follow them exactly."
+
+def _claude_prompt(system,message):
+    # For segmented messages the persona prompt moves after the shared segments, behind a system prompt that is
+    # identical for every persona, so all Claude-served calls in a phase hit the same cached prefix
+    if isinstance(message,str): return system,[{"type":"text","text":message}]
+    blocks=[{"type":"text","text":seg["text"],**({"cache_control":{"type":"ephemeral"}} if seg.get("cache") else {})} for seg in message[:-1]]
+    return CLAUDE_SHARED_SYSTEM,blocks+[{"type":"text","text":f"[YOUR ROLE]\n{system}\n\n{message[-1]['text']}"}]
+
+async def astream_claude(system,message,image_data=None,fallback=None,spec=DEFAULT_SPEC):
+    sys_prompt,blocks=_claude_prompt(system,message); model,max_tokens=MODELS["anthropic"][spec[0]],spec[1]
+    content=[{"type":"image","source":{"type":"base64","media_type":mt,"data":b64}} for mt,b64 in await _image_payloads(image_data,"anthropic")]+blocks
+    async def request(usage):
+        async with get_engine().claude().messages.stream(model=model,max_tokens=max_tokens,system=sys_prompt,messages=[{"role":"user","content":content}]) as s:
+            async for d in s.text_stream: yield d
+            u=(await s.get_final_message()).usage
+            usage.update({"input_tokens":u.input_tokens,"output_tokens":u.output_tokens,"cached_tokens":getattr(u,"cache_read_input_tokens",0) or 0,
+                          "cache_write_tokens":getattr(u,"cache_creation_input_tokens",0) or 0})
+    async for d in _dispatch("anthropic",model,system,message,image_data,max_tokens,request,fallback): yield d
+
+async def astream_gemini(system,message,image_data=None,spec=DEFAULT_SPEC):
+    if not GEMINI_KEY: raise ValueError("GEMINI_API_KEY not set")
+    model,max_tokens=MODELS["gemini"][spec[0]],spec[1]
+    parts=[{"inline_data":{"mime_type":mt,"data":b64}} for mt,b64 in await _image_payloads(image_data,"gemini")]; parts.append({"text":msg_text(message)})
+    async def request(usage):
+        async with get_engine().http(PROVIDER_URLS["gemini"]).stream("POST",f"/v1beta/models/{model}:streamGenerateContent",params={"alt":"sse","key":GEMINI_KEY},
+                                                                     json={"system_instruction":{"parts":[{"text":system}]},"contents":[{"parts":parts}],"generationConfig":{"maxOutputTokens":max_tokens}}) as r:
+            r.raise_for_status()
+            async for ev in _sse_events(r):
+                if ev.get("usageMetadata"):
+                    u=ev["usageMetadata"]; usage.update({"input_tokens":u.get("promptTokenCount",0),"output_tokens":u.get("candidatesTokenCount",0),"cached_tokens":u.get("cachedContentTokenCount",0)})
+                for p in (ev.get("candidates") or [{}])[0].get("content",{}).get("parts",[]):
+                    if p.get("text"): yield p["text"]
+    async for d in _dispatch("gemini",model,system,message,image_data,max_tokens,request): yield d
+
+async def astream_openai_compat(provider,api_key,system,message,image_data=None,spec=DEFAULT_SPEC):
+    # OpenAI and DeepSeek cache identical prompt prefixes automatically; the shared segments already lead the message
+    if image_data: content=[{"type":"image_url","image_url":{"url":f"data:{mt};base64,{b64}"}} for mt,b64 in await _image_payloads(image_data,"openai")]; content.append({"type":"text","text":msg_text(message)})
+    else: content=msg_text(message)
+    async for d in _astream_chat(provider,PROVIDER_URLS[provider],api_key,{"model":MODELS[provider][spec[0]],"messages":[{"role":"system","content":system},{"role":"user","content":content}],"max_tokens":spec[1],
+                                                                          "stream_options":{"include_usage":True}},system,message,image_data): yield d
+
+async def astream_perplexity(system,message,image_data=None,spec=DEFAULT_SPEC):
+    if not PERPLEXITY_KEY: raise ValueError("PERPLEXITY_API_KEY not set")
+    async for d in _astream_chat("perplexity",PROVIDER_URLS["perplexity"],PERPLEXITY_KEY,{"model":MODELS["perplexity"][spec[0]],"messages":[{"role":"system","content":system},{"role":"user","content":msg_text(message)}],
+                                                                                         "max_tokens":spec[1]},system,message): yield d
+
+class Fallback:
+    # Delta marker: drop any partial text, the answer that follows is served by Claude for the given reason
+    __slots__=("reason",)
+    def __init__(self,reason): self.reason=reason
+
+_END=object(); _SENT=object(); _QUEUED=object()
+
+def _why(e):
+    code=getattr(getattr(e,"response",None),"status_code",None)
+    return f"HTTP {code}" if code else (str(e)[:80] if isinstance(e,ValueError) else type(e).__name__)
+
+async def _aclaude_instead(reason,system,message,image_data=None,spec=DEFAULT_SPEC):
+    yield Fallback(reason)
+    async for d in astream_claude(system,message,image_data,reason,spec): yield d
+
+async def _awith_fallback(agen,system,message,image_data=None,provider=None,spec=DEFAULT_SPEC):
+    # Without a provider this is Claude retrying itself once. Otherwise the provider's stream races a Claude hedge
+    # launched at its first-token cutoff; the first to produce text wins and the other is cancelled. Errors,
+    # missed deadlines and mid-stream stalls count against the provider's circuit breaker.
+    if provider is None:
+        started=False
+        try:
+            async for d in agen: started=True; yield d
+        except Exception as e:
+            if started: yield Fallback(_why(e))
+            async for d in astream_claude(system,message,image_data,_why(e),spec): yield d
+        return
+    eng=get_engine(); brk=eng.breaker(provider)
+    if not brk.allow():
+        await agen.aclose()
+        async for d in _aclaude_instead(f"{provider} circuit open",system,message,image_data,spec): yield d
+        return
+    trial=brk.trial   # this call is the half-open trial, and must resolve it on every way out
+    q=asyncio.Queue(); tasks={}
+    def start(name,gen,on_send=None):
+        async def pump():
+            try:
+                async for d in gen: await q.put((name,d))
+                await q.put((name,_END))
+            except Exception as e: await q.put((name,e))
+        tok=_ON_SEND.set(on_send); tasks[name]=asyncio.create_task(pump()); _ON_SEND.reset(tok)
+    def stop(name):
+        t=tasks.pop(name,None)
+        if t: t.cancel()
+    async def nxt(timeout):
+        while True:
+            try: name,d=await asyncio.wait_for(q.get(),timeout)
+            except asyncio.TimeoutError: return None,None
+            if name in tasks: return name,d
+    # The clock starts when the request is sent: time queued on our own rate limiter or a Retry-After isn't latency
+    t0=None; limit=PROVIDER_DEADLINES.get(provider,30.0); hedge=eng.hedge_after(provider); reason=None; winner=None; hedged=False
+    start("primary",agen,lambda sent:q.put_nowait(("primary",_SENT if sent else _QUEUED)))
+    try:
+        while winner is None:
+            wait=max(0.0,t0+(limit if hedged else hedge)-time.monotonic()) if "primary" in tasks and t0 is not None else None
+            name,d=await nxt(wait)
+            if d is _SENT or d is _QUEUED: t0=time.monotonic() if d is _SENT else None; continue
+            if name is None:
+                if not hedged: reason=f"{provider} slower than {hedge:.0f}s"
+                else: stop("primary"); reason=f"{provider} silent for {limit:.0f}s"; brk.failure(reason)
+                if "claude" not in tasks: start("claude",astream_claude(system,message,image_data,reason,spec)); hedged=True
+            elif isinstance(d,Exception):
+                stop(name)
+                if name=="claude":
+                    if "primary" not in tasks: raise d
+                else:
+                    reason=f"{provider} {_why(d)}"; brk.failure(reason)
+                    if "claude" not in tasks: start("claude",astream_claude(system,message,image_data,reason,spec)); hedged=True
+            else:
+                winner=name; stop("claude" if name=="primary" else "primary")
+                if name=="primary":
+                    if t0 is not None: eng.ttft[provider].append(time.monotonic()-t0)   # a cache hit never sends
+                else:
+                    if trial and brk.trial: brk.failure(reason)   # a trial that loses to the hedge hasn't shown the provider is back
+                    yield Fallback(reason)
+                if d is _END:
+                    if name=="primary": brk.success()
+                    return
+                yield d
+        while True:
+            name,d=await nxt(limit if winner=="primary" else None)
+            if d is _END:
+                if winner=="primary": brk.success()
+                return
+            if name is None or isinstance(d,Exception):
+                if winner=="claude": raise d
+                reason=f"{provider} stalled" if name is None else f"{provider} {_why(d)}"; break
+            yield d
+        stop("primary"); brk.failure(reason)
+        async for d in _aclaude_instead(reason,system,message,image_data,spec): yield d
+    finally:
+        for t in tasks.values(): t.cancel()
+        if trial and brk.trial: brk.settle()
+
+def astream_persona(persona,prompt_type,message,image_data=None,profile=DEFAULT_PROFILE):
+    system=PERSONAS[persona][prompt_type]; provider=PERSONA_PROVIDER[persona]; spec=model_spec(prompt_type,profile,persona)
+    if provider=="anthropic": return _awith_fallback(astream_claude(system,message,image_data,spec=spec),system,message,image_data,spec=spec)
+    if not {"gemini":GEMINI_KEY,"openai":OPENAI_KEY,"perplexity":PERPLEXITY_KEY,"deepseek":DEEPSEEK_KEY}[provider]: return _aclaude_instead(f"no {provider} key",system,message,image_data,spec)
+    if persona=="gemini": agen=astream_gemini(system,message,image_data,spec)
+    elif persona=="gpt4": agen=astream_openai_compat("openai",OPENAI_KEY,system,message,image_data,spec)
+    elif persona=="perplexity": agen=astream_perplexity(system,message,image_data,spec)
+    else: agen=astream_openai_compat("deepseek",DEEPSEEK_KEY,system,message,None,spec)
+    return _awith_fallback(agen,system,message,image_data,provider,spec)
+
+def astream_factcheck(prompt,spec=DEFAULT_SPEC,system=FACTCHECK_SYSTEM):
+    if not PERPLEXITY_KEY: return _awith_fallback(astream_claude(system,prompt,spec=spec),system,prompt,spec=spec)
+    return _awith_fallback(astream_perplexity(system,prompt,spec=spec),system,prompt,None,"perplexity",spec)
+
+async def _collect(agen):
+    text=""
+    async for d in agen: text="" if isinstance(d,Fallback) else text+d
+    return text
+
+async def acall_persona(persona,prompt_type,message,image_data=None,profile=DEFAULT_PROFILE):
+    return await _collect(astream_persona(persona,prompt_type,message,image_data,profile))
+
+async def arun_parallel(tasks):
+    results=await asyncio.gather(*(acall_persona(*t) for t in tasks),return_exceptions=True)
+    return [f"Error:{r}" if isinstance(r,BaseException) else r for r in results]
+
+# ─── Sync entry points for the Streamlit script thread ─────────────
+def call_claude(system,message,image_data=None,spec=DEFAULT_SPEC): return get_engine().run(_collect(astream_claude(system,message,image_data,spec=spec)))
+def run_parallel(tasks): return get_engine().run(arun_parallel(tasks))
+def stream_claude(system,message,image_data=None,spec=DEFAULT_SPEC): return get_engine().iterate(astream_claude(system,message,image_data,spec=spec))
+def stream_factcheck(prompt,spec=DEFAULT_SPEC): return get_engine().iterate(astream_factcheck(prompt,spec))
+
+def run_parallel_stream(tasks,on_update,interval=0.15,fallbacks=None):
+    # The fan-out runs on the engine loop; the script thread drains deltas so only it touches Streamlit elements.
+    # Fallback reasons land in `fallbacks` by task index.
+    texts=[""]*len(tasks); q=queue.Queue(); done=object(); fallbacks=fallbacks if fallbacks is not None else {}
+    async def one(i,t):
+        try:
+            async for d in astream_persona(*t): q.put((i,d))
+        except Exception as e: q.put((i,None)); q.put((i,f"Error:{e}"))
+        finally: q.put((i,done))
+    async def fanout(): await asyncio.gather(*(one(i,t) for i,t in enumerate(tasks)))
+    fut=get_engine().submit(fanout())
     try:
-        if persona=="gemini": return call_gemini(system,message,image_data)
-        elif persona=="gpt4": return call_openai_compat(OPENAI_KEY,"https://api.openai.com/v1","gpt-4o",system,message,image_data) if OPENAI_KEY else call_claude(system,message,image_data)
-        elif persona=="perplexity": return call_perplexity(system,message,image_data)
-        elif persona=="deepseek": return call_openai_compat(DEEPSEEK_KEY,"https://api.deepseek.com/v1","deepseek-chat",system,message,None) if DEEPSEEK_KEY else call_claude(system,message,image_data)
-        else: return call_claude(system,message,image_data)
-    except: return call_claude(system,message,image_data)
-
-def run_parallel(tasks):
-    results=[None]*len(tasks)
-    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as ex:
-        fmap={ex.submit(call_persona,*t):i for i,t in enumerate(tasks)}
-        for f in concurrent.futures.as_completed(fmap):
-            idx=fmap[f]
-            try: results[idx]=f.result()
-            except Exception as e: results[idx]=f"Error:{e}"
-    return results
+        pending,finished,dirty,last=len(tasks),set(),set(),0.0
+        while pending:
+            try:
+                i,d=q.get(timeout=interval); dirty.add(i)
+                if d is done: pending-=1; finished.add(i)
+                elif d is None: texts[i]=""
+                elif isinstance(d,Fallback): texts[i]=""; fallbacks[i]=d.reason
+                else: texts[i]+=d
+            except queue.Empty: pass
+            if dirty and (not pending or time.monotonic()-last>=interval):
+                for i in dirty: on_update(i,texts[i],i in finished,fallbacks.get(i))
+                dirty.clear(); last=time.monotonic()
+    finally: fut.cancel()
+    return texts
+
+# ─── Background discussion jobs: phases run off the script thread and checkpoint as they finish ───
+JOB_WORKERS = 8
+JOB_POLL = 0.2
+JOBS_FILE = os.path.join(DATA_DIR,"nexus_jobs.json")   # beside the history, not in CACHE_DIR where the response cache trims files
+
+# Adaptive rounds: when the round-1 answers already agree, skip the debate or let only the outliers debate
+ADAPTIVE = {"enabled":True,"skip":0.65,"subset":0.45,"subset_size":3,"min_answers":4}
+SAT_OUT = "Sat out the debate: this answer was already in line with the others."
+
+def agreement(texts):
+    # Pairwise cosine of sublinear TF-IDF vectors; returns (mean score, each answer's mean similarity to the rest)
+    docs=[collections.Counter(re.findall(r"[a-z0-9]{3,}",t.lower())) for t in texts]; n=len(docs)
+    df=collections.Counter(w for d in docs for w in d)
+    vecs=[{w:(1+math.log(c))*(math.log((1+n)/(1+df[w]))+1) for w,c in d.items()} for d in docs]
+    norms=[math.sqrt(sum(v*v for v in vec.values())) or 1.0 for vec in vecs]
+    sim=[[sum(v*vecs[j].get(w,0.0) for w,v in vecs[i].items())/(norms[i]*norms[j]) for j in range(n)] for i in range(n)]
+    each=[sum(sim[i][j] for j in range(n) if j!=i)/max(1,n-1) for i in range(n)]
+    return sum(each)/max(1,n),each
+
+def plan_debate(r1):
+    # Failed answers can't vouch for a consensus, so too few usable answers always means a full debate
+    ok=[p for p in PERSONAS_ORDER if r1.get(p) and not r1[p].startswith("Error:")]
+    if len(ok)<ADAPTIVE["min_answers"]: return {"mode":"full","score":None}
+    score,each=agreement([r1[p] for p in ok]); score=round(score,3)
+    if score>=ADAPTIVE["skip"]: return {"mode":"skip","score":score}
+    if score>=ADAPTIVE["subset"]: return {"mode":"subset","score":score,"personas":[p for _,p in sorted(zip(each,ok))][:ADAPTIVE["subset_size"]]}
+    return {"mode":"full","score":score}
+
+def debate_tasks(q,r1,text_context="",personas=PERSONAS_ORDER,profile=DEFAULT_PROFILE):
+    # Every persona sees the same round-1 block, so personas served by one provider share a cacheable prefix
+    prefix={}
+    def make(me):
+        prov=PERSONA_PROVIDER[me]
+        if prov not in prefix:
+            fitted=fit_sections([r1[p] for p in PERSONAS_ORDER],PHASE_BUDGETS["debate"],prov)
+            prefix[prov]=text_context+f'Original: "{q}"\n\n'+"\n\n".join(f"{AI_CONFIG[p]['name'].upper()}:\n{a}" for p,a in zip(PERSONAS_ORDER,fitted))+"\n\n"
+        return [{"text":prefix[prov],"cache":True},{"text":f"You are {AI_CONFIG[me]['name']}; your own answer is labeled {AI_CONFIG[me]['name'].upper()} above. Engage genuinely. Agree, challenge, extend."}]
+    return [(p,"debate",make(p),None,profile) for p in personas]
+
+def synthesis_prompt(q,r1,r2,plan=None):
+    debaters=[p for p in PERSONAS_ORDER if p in r2]; mode=(plan or {}).get("mode","full")
+    answers=fit_sections([r1[p] for p in PERSONAS_ORDER]+[r2[p] for p in debaters],PHASE_BUDGETS["synthesis"])
+    note={"skip":"\n\n(The round-1 answers largely agreed, so no debate round was run.)","subset":"\n\n(Only the most divergent voices debated in round 2.)"}.get(mode,"")
+    return (f'QUESTION: "{q}"\n\nROUND 1:\n'+"\n\n".join(f"[{AI_CONFIG[p]['name']}]\n{a}" for p,a in zip(PERSONAS_ORDER,answers[:5]))
+            +("\n\nROUND 2:\n"+"\n\n".join(f"[{AI_CONFIG[p]['name']}]\n{a}" for p,a in zip(debaters,answers[5:])) if debaters else "")+note+"\n\nSynthesize.")
+
+def followup_prompt(disc,fu):
+    # Rebuilt from the saved discussion at each step, so a resumed job sends exactly what the first attempt would have
+    return followup_history(disc["question"],disc["synthesis"],disc.get("followups",[]),disc.get("rolling_summary"))+[{"text":fu.get("text_context","")+f'NEW: "{fu["question"]}"'}]
+
+# Claim-level fact-checking: each sentence-sized claim of a synthesis is verified on its own, starting while
+# the synthesis is still streaming, and the verdicts are merged into one verification text
+CLAIM_CHECK = {"enabled":True,"concurrency":4,"max_claims":10,"min_words":6,"context_chars":300}   # claims past max_claims share one batched check
+VERDICT_MARKS = {"SUPPORTED":"✓","DISPUTED":"✗","UNVERIFIED":"?"}
+_SENTENCE = re.compile(r"(?<=[.!?])\s+|\n+")
+
+def split_claims(text,final=True):
+    # Every checkable sentence as (claim, the sentence before it), so a claim leaning on "it" or "this" can be judged
+    parts=_SENTENCE.split(text)
+    if not final: parts=parts[:-1]   # the last piece may still be growing
+    claims,prev=[],""
+    for part in parts:
+        c=re.sub(r"^\s*(?:#+|>|[-*•]|\d+[.)])\s+","",part).replace("**","").strip()
+        if len(c.split())>=CLAIM_CHECK["min_words"] and not c.endswith((":","?")): claims.append((c,prev[-CLAIM_CHECK["context_chars"]:]))
+        if len(c.split())>1: prev=c   # not a bare list number
+    return claims
+
+def parse_verdict(text):
+    m=re.search(r"\**VERDICT\**:\W*(SUPPORTED|DISPUTED|UNVERIFIED)\**",text,re.I)
+    note=" ".join((text[:m.start()]+text[m.end():] if m else text).split()).strip(" —–-:")
+    return {"verdict":m.group(1).upper() if m else "UNVERIFIED","note":note}
+
+def format_verdicts(results):
+    # results: [(claim, verdict or None while still checking)]
+    done=[v["verdict"] for _,v in results if v]
+    lines=[f"{len(done)}/{len(results)} claims checked · "+" · ".join(f"{done.count(k)} {k.lower()}" for k in VERDICT_MARKS)]
+    for claim,v in results:
+        if v is None: lines.append(f"… CHECKING — {claim}")
+        else: lines.append(f"{VERDICT_MARKS[v['verdict']]} {v['verdict']} — {claim}"+(f"\n   {v['note']}" if v["note"] else ""))
+    return "\n\n".join(lines)
+
+class ClaimChecks:
+    # The first CLAIM_CHECK["max_claims"] claims are submitted to the engine loop as soon as they are complete; at
+    # most CLAIM_CHECK["concurrency"] are in flight. The rest go out together in one batched check once the text is
+    # final, so every claim gets a verdict. Call records collect in a trace of their own, merged into the fact-check phase.
+    def __init__(self,question,spec):
+        self.question,self.spec=question,spec; self.futures={}; self.batch=None; self.sem=None; self.trace={"phase":"factcheck","calls":[]}
+
+    def feed(self,text,final=False):
+        claims=split_claims(text,final); tok=_TRACE.set(self.trace); n=CLAIM_CHECK["max_claims"]
+        try:
+            for c,ctx in claims[:n]:
+                if c not in self.futures: self.futures[c]=get_engine().submit(self._check(c,ctx))
+            rest=[(c,ctx) for c,ctx in claims[n:] if c not in self.futures]
+            if final and rest and self.batch is None: self.batch=get_engine().submit(self._check_batch(rest))
+        finally: _TRACE.reset(tok)
+        return [c for c,_ in claims]
+
+    def _prompt(self,claim,ctx): return f"CONTEXT: {ctx}\nCLAIM: {claim}" if ctx else f"CLAIM: {claim}"
+
+    async def _check(self,claim,ctx):
+        if self.sem is None: self.sem=asyncio.Semaphore(CLAIM_CHECK["concurrency"])   # created on the loop that uses it
+        async with self.sem:
+            return parse_verdict(await _collect(astream_factcheck(f'QUESTION: "{self.question}"\n\n{self._prompt(claim,ctx)}',self.spec,CLAIMCHECK_SYSTEM)))
+
+    async def _check_batch(self,claims):
+        if self.sem is None: self.sem=asyncio.Semaphore(CLAIM_CHECK["concurrency"])
+        listed="\n\n".join(f"{i}. {self._prompt(c,ctx)}" for i,(c,ctx) in enumerate(claims,1))
+        async with self.sem:
+            text=await _collect(astream_factcheck(f'QUESTION: "{self.question}"\n\n{listed}',self.spec,CLAIMBATCH_SYSTEM))
+        lines={int(m.group(1)):m.group(2) for m in re.finditer(r"^\W*(\d+)[.)]\s*(.+)$",text,re.M)}
+        return {c:parse_verdict(lines[i]) if i in lines else {"verdict":"UNVERIFIED","note":"Not covered by the batched check."} for i,(c,_) in enumerate(claims,1)}
+
+    def waiting(self,claims): return [self.futures[c] for c in claims if c in self.futures]+([self.batch] if self.batch else [])
+
+    def cancel(self):
+        for f in self.waiting(list(self.futures)): f.cancel()
+
+    def results(self,claims):
+        out=[]
+        for c in claims:
+            f=self.futures.get(c,self.batch)
+            if f is None or not f.done(): out.append((c,None))
+            elif f.exception(): out.append((c,{"verdict":"UNVERIFIED","note":f"Check failed: {str(f.exception())[:100]}"}))
+            else: out.append((c,f.result() if c in self.futures else f.result()[c]))
+        return out
+
+def next_step(disc):
+    if not disc.get("r1"): return "r1"
+    if not disc.get("r2") and (disc.get("adaptive") or {}).get("mode")!="skip": return "r2"
+    if not disc.get("synthesis"): return "synthesis"
+    if not disc.get("factcheck"): return "factcheck"
+    fu=disc.get("pending_followup")
+    if not fu: return None
+    return "fu_responses" if not fu.get("responses") else "fu_synthesis" if not fu.get("synthesis") else "fu_factcheck"
+
+def phase_timing(seconds,calls):
+    # Compact per-call records kept on the discussion for the diagnostics panel
+    return {"seconds":round(seconds,2),"calls":[{k:round(c[k],3) if isinstance(c.get(k),float) else c.get(k) for k in CALL_FIELDS if c.get(k) is not None} for c in calls]}
+
+def _job_images(disc):
+    # Hashes of the images a discussion's pending steps will still send
+    return {img["hash"] for src in (disc.get("job"),disc.get("pending_followup")) for img in (src or {}).get("images") or []}
+
+class JobCancelled(Exception): pass
+
+class DiscussionJob:
+    # Runs one discussion's remaining steps on a worker thread. Only the worker mutates `disc`, under the lock;
+    # the UI reads snapshots plus the live text of the step in flight. Each finished step is saved before the next.
+    def __init__(self,disc,sid):
+        self.disc,self.sid=disc,sid; self.lock=threading.Lock(); self.step=next_step(disc)
+        self.texts,self.fallbacks,self.text,self.seq,self.error,self.done={}, {}, "",0,None,False
+        self.checks=None   # claim checks started by a synthesis step, finished by the fact-check step after it
+        self.images=_job_images(disc); self.cancelled=False
+
+    def cancel(self):
+        with self.lock: self.cancelled=True
+
+    def _alive(self):
+        # Checked under the lock by every progress update; raising out of the stream cancels its provider calls
+        if self.cancelled: raise JobCancelled()
+
+    def snapshot(self):
+        with self.lock: return copy.deepcopy(self.disc)
+
+    def live(self):
+        with self.lock: return {"step":self.step,"texts":dict(self.texts),"fallbacks":dict(self.fallbacks),"text":self.text}
+
+    def _fan_out(self,tasks):
+        by_index={}
+        def upd(i,text,final,fb):
+            with self.lock:
+                self._alive(); self.texts[tasks[i][0]]=text
+                if fb: self.fallbacks[tasks[i][0]]=fb
+        results=run_parallel_stream(tasks,upd,fallbacks=by_index)
+        return dict(zip([t[0] for t in tasks],results)),{tasks[i][0]:r for i,r in by_index.items()}
+
+    def _stream(self,gen,on_text=None):
+        text=""
+        for d in gen:
+            text="" if isinstance(d,Fallback) else text+d
+            with self.lock: self._alive(); self.text=text
+            if on_text: on_text(text)
+        return text
+
+    def _synthesize(self,system,prompt,q,profile):
+        self.checks=ClaimChecks(q,model_spec("factcheck",profile)) if CLAIM_CHECK["enabled"] else None
+        return self._stream(stream_claude(system,prompt,spec=model_spec("synthesis",profile)),self.checks and self.checks.feed)
+
+    def _factcheck(self,prompt,spec,q,synthesis):
+        # Waits on the claim checks the synthesis started (or starts them after a resume); a synthesis with no
+        # checkable claims gets one whole-text check instead
+        checks,self.checks=self.checks or (ClaimChecks(q,spec) if CLAIM_CHECK["enabled"] else None),None
+        claims=checks.feed(synthesis,final=True) if checks else []
+        if not claims:
+            try: return self._stream(stream_factcheck(prompt,spec))
+            except Exception as e: return f"Fact-check unavailable: {str(e)[:100]}"
+        try:
+            for _ in concurrent.futures.as_completed(checks.waiting(claims)):
+                with self.lock: self._alive(); self.text=format_verdicts(checks.results(claims))
+        except JobCancelled: checks.cancel(); raise
+        _TRACE.get()["calls"].extend(checks.trace["calls"])
+        return format_verdicts(checks.results(claims))
+
+    def _run_step(self,step,disc):
+        # Returns a function applying the step's result to the live discussion
+        q,inputs,fu=disc["question"],disc.get("job") or {},disc.get("pending_followup") or {}
+        profile=disc.get("profile") or DEFAULT_PROFILE
+        images=(inputs if step=="r1" else fu if step=="fu_responses" else {}).get("images") or []
+        missing=[img["name"] for img in images if not get_image_store().has(img["hash"])]
+        if missing: raise RuntimeError(f"uploaded image no longer available: {', '.join(missing)}")
+        if step=="r1":
+            r1,fb=self._fan_out([(p,"initial",inputs.get("text_context","")+q,inputs.get("images") or None,profile) for p in PERSONAS_ORDER])
+            plan=plan_debate(r1) if inputs.get("adaptive",ADAPTIVE["enabled"]) else {"mode":"full","score":None}
+            get_metrics().inc("nexus_debate_plans_total",{"mode":plan["mode"]})
+            def apply(d):
+                d.update(r1=r1,phase=3 if plan["mode"]=="skip" else 2,fallbacks={**d.get("fallbacks",{}),"r1":fb},adaptive=plan)
+                if plan["mode"]=="skip": d.pop("job",None)
+            return apply
+        if step=="r2":
+            r2,fb=self._fan_out(debate_tasks(q,disc["r1"],inputs.get("text_context",""),(disc.get("adaptive") or {}).get("personas") or PERSONAS_ORDER,profile))
+            return lambda d:(d.update(r2=r2,phase=3,fallbacks={**d.get("fallbacks",{}),"r2":fb}),d.pop("job",None))
+        if step=="synthesis":
+            text=self._synthesize(SYNTH_SYSTEM,synthesis_prompt(q,disc["r1"],disc.get("r2") or {},disc.get("adaptive")),q,profile)
+            return lambda d:d.update(synthesis=text,phase=4)
+        if step=="factcheck":
+            text=self._factcheck(f'QUESTION: "{q}"\n\nSYNTHESIS:\n{disc["synthesis"]}\n\nFact-check with skepticism. Verify claims, flag hallucinations, cite sources. 2-3 paragraphs.',model_spec("factcheck",profile),q,disc["synthesis"])
+            return lambda d:d.update(factcheck=text)
+        if step=="fu_responses":
+            summary=compact_followups(disc.get("followups",[]),disc.get("rolling_summary"),model_spec("summary",profile)); disc["rolling_summary"]=summary
+            responses,fb=self._fan_out([(p,"followup",followup_prompt(disc,fu),fu.get("images") or None,profile) for p in PERSONAS_ORDER])
+            return lambda d:(d.update(rolling_summary=summary),d["pending_followup"].update(responses=responses,fallbacks=fb))
+        if step=="fu_synthesis":
+            hctx=followup_prompt(disc,fu)
+            text=self._synthesize(FOLLOWUP_SYNTH_SYSTEM,hctx[:-1]+[{"text":hctx[-1]["text"]+"\n\nRESPONSES:\n"+"\n\n".join(f"[{AI_CONFIG[p]['name']}]\n{a}" for p,a in zip(PERSONAS_ORDER,fit_sections([fu["responses"][p] for p in PERSONAS_ORDER],PHASE_BUDGETS["followup"])))+"\n\nSynthesize."}],fu["question"],profile)
+            return lambda d:d["pending_followup"].update(synthesis=text)
+        text=self._factcheck(f'ORIGINAL: "{q}"\n\nFOLLOW-UP: "{fu["question"]}"\n\nFOLLOW-UP SYNTHESIS:\n{fu["synthesis"]}\n\nFact-check this follow-up response. Verify claims, cite sources. 2 paragraphs.',model_spec("factcheck",profile),fu["question"],fu["synthesis"])
+        def finish(d):
+            pf=d.pop("pending_followup")
+            d["followups"]=d.get("followups",[])+[{"question":pf["question"],"responses":pf["responses"],"synthesis":pf["synthesis"],"factcheck":text,"context_summary":pf.get("context_summary",""),"fallbacks":pf.get("fallbacks",{})}]
+        return finish
+
+    def run(self):
+        _SESSION.set(self.sid)
+        while True:
+            with self.lock:
+                if self.cancelled: return
+                step=self.step=next_step(self.disc); self.texts,self.fallbacks,self.text={}, {}, ""
+                label=step if step is None or not step.startswith("fu_") else f"followup {len(self.disc.get('followups',[]))+1} {step[3:]}"
+            if step is None: return
+            trace={"phase":step,"calls":[]}; _TRACE.set(trace); t0=time.monotonic()
+            try: apply=self._run_step(step,self.snapshot())
+            except JobCancelled:
+                if self.checks: self.checks.cancel()
+                return
+            timing=phase_timing(time.monotonic()-t0,trace["calls"]); get_metrics().observe("nexus_phase_seconds",timing["seconds"],{"phase":step})
+            with self.lock:
+                # Saved under the lock so a delete lands either before this checkpoint (and stops it) or after it
+                if self.cancelled: return
+                apply(self.disc); self.disc.setdefault("timings",{})[label]=timing
+                if next_step(self.disc)==step: raise RuntimeError(f"{step} produced no output")
+                snap=copy.deepcopy(self.disc); save_discussion(snap); get_bodies().refresh(snap)
+                self.seq+=1   # last: a follower reruns on this, and must find the new body already cached
+
+class JobRunner:
+    # Bounded worker pool for discussion jobs. Live jobs are journalled so a restarted process resumes them
+    # from their last saved step.
+    def __init__(self,workers=JOB_WORKERS,journal=JOBS_FILE):
+        self.pool=concurrent.futures.ThreadPoolExecutor(workers,thread_name_prefix="nexus-job")
+        self.journal=journal; self.jobs={}; self.lock=threading.Lock()
+        for disc_id,sid in self._read().items():
+            disc=get_discussion(disc_id)
+            if disc and next_step(disc): self.submit(disc,sid)
+            else: self._record(disc_id,None)
+
+    def _read(self):
+        try:
+            with open(self.journal,encoding="utf-8") as f: return json.load(f)
+        except (OSError,ValueError): return {}
+
+    def _record(self,disc_id,sid):
+        with self.lock:
+            live=self._read()
+            if sid is None: live.pop(disc_id,None)
+            else: live[disc_id]=sid
+            os.makedirs(os.path.dirname(self.journal),exist_ok=True); tmp=self.journal+".tmp"
+            with open(tmp,"w",encoding="utf-8") as f: json.dump(live,f)
+            os.replace(tmp,self.journal)
+
+    def get(self,disc_id):
+        with self.lock: return self.jobs.get(disc_id)
+
+    def cancel(self,disc_id):
+        job=self.get(disc_id)
+        if job: job.cancel()
+
+    def submit(self,disc,sid):
+        # Saves the inputs first, so even a job that dies before its first step can be resumed
+        with self.lock:
+            job=self.jobs.get(disc["id"])
+            if job and not job.done: return job
+            job=self.jobs[disc["id"]]=DiscussionJob(disc,sid)
+        get_image_store().pin(job.images)
+        save_discussion(job.snapshot()); self._record(disc["id"],sid)
+        self.pool.submit(self._run,job)
+        return job
+
+    def _run(self,job):
+        m=get_metrics(); m.add("nexus_jobs_running")
+        try: job.run()
+        except Exception as e: job.error=str(e)[:200]; m.inc("nexus_jobs_failed_total")
+        finally:
+            job.done=True; self._record(job.disc["id"],None); m.add("nexus_jobs_running",v=-1); get_image_store().unpin(job.images)
+            # A finished job's result lives on in storage and the body cache; only failed jobs stay to show their error
+            with self.lock:
+                if not job.error and self.jobs.get(job.disc["id"]) is job: del self.jobs[job.disc["id"]]
+                if not job.error: get_image_store().discard(job.images-set().union(*(j.images for j in self.jobs.values())))
+
+@st.cache_resource
+def get_job_runner():
+    return JobRunner()
+
+def _follow_job(job,render):
+    # Redraw the step in flight from the job's live state until it checkpoints, then rerun to draw the saved result
+    seq,last=job.seq,None
+    while not job.done and job.seq==seq:
+        cur=job.live()
+        if cur!=last: render(cur); last=cur
+        time.sleep(JOB_POLL)
+    st.rerun()
+
+def _live_cards(label,waiting="⟳ Thinking...",personas=PERSONAS_ORDER):
+    cards=[c.empty() for c in st.columns(5)]
+    def render(live):
+        for i,p in enumerate(PERSONAS_ORDER):
+            if p not in personas: cards[i].markdown(ai_card_html(p,SAT_OUT,label),unsafe_allow_html=True); continue
+            t=live["texts"].get(p,"")
+            cards[i].markdown(ai_card_html(p,t+"▌" if t else waiting,label,live["fallbacks"].get(p)),unsafe_allow_html=True)
+    return render
+
+def _live_text(render_html):
+    ph=st.empty()
+    return lambda live:ph.markdown(render_html(live["text"]+"▌"),unsafe_allow_html=True)
 
 # Enhanced AI card with better visual hierarchy
-def ai_card_html(persona,text,label=""):
+def ai_card_html(persona,text,label="",fallback=None):
     cfg=AI_CONFIG[persona]; safe=text.replace("&","&amp;").replace("<","&lt;").replace(">","&gt;")
     lbl=f'<div style="position:absolute;top:16px;right:16px;font-size:9px;color:#5A6A7A;background:rgba(15,20,25,0.8);padding:4px 10px;border-radius:6px;font-weight:600;letter-spacing:0.05em">{label}</div>' if label else ""
+    fb=f'<div style="font-size:10px;color:#F59E0B;background:rgba(245,158,11,0.08);border:1px solid rgba(245,158,11,0.3);border-radius:6px;padding:4px 10px;margin:-6px 0 12px;font-weight:600">↪ Served by Claude · {html.escape(fallback)}</div>' if fallback else ""
     return (f'<div style="position:relative;background:{cfg["bg"]};border:1.5px solid {cfg["border"]};border-radius:16px;padding:24px;min-height:180px;'
             f'box-shadow:0 2px 8px rgba(0,0,0,0.15);transition:all 0.2s ease">'
             f'{lbl}'
             f'<div style="display:flex;align-items:center;gap:12px;margin-bottom:16px">'
             f'<div style="font-size:24px">{cfg["icon"]}</div>'
             f'<div style="flex:1"><div style="color:{cfg["color"]};font-weight:700;font-size:14px;letter-spacing:0.02em">{cfg["name"]}</div>'
-            f'<div style="color:#5A6A7A;font-size:11px;font-weight:500;margin-top:2px">{cfg["maker"]}</div></div></div>'
+            f'<div style="color:#5A6A7A;font-size:11px;font-weight:500;margin-top:2px">{cfg["maker"]}</div></div></div>{fb}'
             f'<div style="color:#C5D1DE;font-size:13px;line-height:1.8;white-space:pre-wrap;word-break:break-word">{safe}</div></div>')
 
+def synthesis_html(text):
+    safe=text.replace("&","&amp;").replace("<","&lt;").replace(">","&gt;")
+    return (f'<div style="background:linear-gradient(135deg,rgba(16,185,129,0.08),rgba(16,185,129,0.04));border:2px solid rgba(16,185,129,0.4);border-radius:16px;padding:32px;box-shadow:0 4px 16px rgba(16,185,129,0.15)">'
+            f'<div style="display:flex;align-items:center;gap:16px;margin-bottom:20px">'
+            f'<div style="width:40px;height:40px;border-radius:50%;background:linear-gradient(135deg,#10B981,#059669);display:flex;align-items:center;justify-content:center;font-size:20px">✦</div>'
+            f'<div><div style="font-size:16px;font-weight:700;color:#10B981;letter-spacing:0.02em">SYNTHESIZED ANSWER</div>'
+            f'<div style="font-size:11px;color:#5A6A7A;font-weight:600;margin-top:2px">Claude · Gemini · GPT-4 · Perplexity · DeepSeek</div></div></div>'
+            f'<div style="color:#C5D1DE;font-size:14.5px;line-height:1.9;white-space:pre-wrap">{safe}</div></div>')
+
+def fu_synthesis_html(text):
+    safe=text.replace("&","&amp;").replace("<","&lt;").replace(">","&gt;")
+    return (f'<div style="background:linear-gradient(135deg,rgba(91,141,239,0.08),rgba(91,141,239,0.04));border:1.5px solid rgba(91,141,239,0.4);border-radius:12px;padding:24px;margin-top:16px">'
+            f'<div style="font-size:13px;font-weight:700;color:#5B8DEF;margin-bottom:12px">↩ UPDATED SYNTHESIS</div>'
+            f'<div style="color:#C5D1DE;font-size:13.5px;line-height:1.8;white-space:pre-wrap">{safe}</div></div>')
+
+def factcheck_html(text,source="",padding=24):
+    safe=text.replace("&","&amp;").replace("<","&lt;").replace(">","&gt;")
+    return (f'<div style="background:linear-gradient(135deg,rgba(251,191,36,0.08),rgba(251,191,36,0.04));border:1.5px solid rgba(251,191,36,0.4);border-radius:12px;padding:{padding}px">'
+            f'<div style="color:#FBB020;font-size:11px;font-weight:700;letter-spacing:0.08em;margin-bottom:{12 if padding>20 else 10}px">⚠ {source+" " if source else ""}VERIFICATION</div>'
+            f'<div style="color:#C5D1DE;font-size:13px;line-height:1.8;white-space:pre-wrap">{safe}</div></div>')
+
+# Finished text never changes, so its HTML is built once per content hash and shared by every rerun and session.
+# Text still streaming goes through the builders directly.
+HTML_CACHE_ENTRIES = 4000
+
+@st.cache_data(max_entries=HTML_CACHE_ENTRIES,show_spinner=False)
+def _memo_html(digest,builder,kw,_text):
+    return globals()[builder](text=_text,**dict(kw))
+
+def memo_html(builder,text,**kw):
+    return _memo_html(hashlib.sha1(text.encode("utf-8","surrogatepass")).hexdigest(),builder.__name__,tuple(sorted(kw.items())),text)
+
 def phase_header(num,title,state):
     icons={"waiting":"○","active":"◉","done":"✓"}
     colors={"waiting":"#2A3A4A","active":"#5B8DEF","done":"#10B981"}
@@ -351,6 +1949,17 @@ def key_status_banner():
                 f'<div style="margin-left:auto;font-size:11px;font-weight:700;color:#5A6A7A;letter-spacing:0.08em">STORAGE</div>'
                 f'<div style="font-size:12px">{db}</div></div>',unsafe_allow_html=True)
 
+def build_context(files,urls=()):
+    # files are (name, media type, bytes); returns (text context, image refs, summary) for the UI and batch runs alike
+    text_items,image_data,summary=[],[],[]
+    for name,media_type,fb in files:
+        if media_type=="application/pdf": text_items.append({"label":f"PDF:{name}","content":extract_pdf_text(fb)}); summary.append(f"📄 {name}")
+        elif media_type.startswith("image/"): image_data.append({"hash":get_image_store().add(fb,media_type),"media_type":media_type,"name":name,"size":len(fb)}); text_items.append({"label":f"Image:{name}","content":f"[Image '{name}' provided]"}); summary.append(f"🖼 {name}")
+        elif media_type.startswith("text/"): text_items.append({"label":f"File:{name}","content":fb.decode("utf-8",errors="replace")}); summary.append(f"📄 {name}")
+    if urls:
+        for u,t in zip(urls,fetch_urls(list(urls))): text_items.append({"label":f"URL:{u}","content":t}); summary.append(f"🔗 {u[:30]}...")
+    return build_text_context(text_items),image_data,", ".join(summary)
+
 def render_context_inputs(key_suffix="main"):
     c1,c2=st.columns([3,2])
     with c1:
@@ -358,17 +1967,10 @@ def render_context_inputs(key_suffix="main"):
         uploaded=st.file_uploader("up",type=["pdf","png","jpg","jpeg","webp","gif"],accept_multiple_files=True,label_visibility="collapsed",key=f"upload_{key_suffix}")
     with c2:
         st.markdown('<div style="font-size:12px;color:#7A8A9A;margin-bottom:8px;font-weight:600">🔗 URL</div>',unsafe_allow_html=True)
-        url_input=st.text_input("url",placeholder="https://...",label_visibility="collapsed",key=f"url_{key_suffix}")
-    text_items,image_data,summary=[],[],[]
-    if uploaded:
-        for f in uploaded:
-            fb=f.read()
-            if f.type=="application/pdf": text_items.append({"label":f"PDF:{f.name}","content":extract_pdf_text(fb)}); summary.append(f"📄 {f.name}")
-            elif f.type.startswith("image/"): b64=base64.b64encode(fb).decode(); image_data.append({"media_type":f.type,"data":b64,"name":f.name}); text_items.append({"label":f"Image:{f.name}","content":f"[Image '{f.name}' provided]"}); summary.append(f"🖼 {f.name}")
-    if url_input and url_input.strip().startswith("http"):
-        with st.spinner("Fetching..."): text_items.append({"label":f"URL:{url_input}","content":fetch_url_text(url_input.strip())})
-        summary.append(f"🔗 {url_input[:30]}...")
-    return build_text_context(text_items),image_data,", ".join(summary)
+        url_input=st.text_input("url",placeholder="https://... (separate several with spaces)",label_visibility="collapsed",key=f"url_{key_suffix}")
+    urls=[u for u in re.split(r"[\s,]+",url_input or "") if u.startswith("http")]
+    with st.spinner("Fetching...") if urls else contextlib.nullcontext():
+        return build_context([(f.name,f.type,f.read()) for f in uploaded or []],urls)
 
 def render_context_panel():
     with st.expander("📎  Context — attach files, images, or URLs",expanded=False):
@@ -383,102 +1985,166 @@ def copy_button_html(text):
     safe=text.replace("&","&amp;").replace("<","&lt;").replace(">","&gt;").replace('"',"&quot;").replace("'","&#39;")
     return f'<textarea id="nxc" readonly style="position:fixed;top:-9999px;opacity:0">{safe}</textarea><button id="nxb" onclick="var e=document.getElementById(\'nxc\');e.style.position=\'fixed\';e.style.top=\'0\';e.select();try{{navigator.clipboard.writeText(e.value).then(()=>{{document.getElementById(\'nxb\').innerText=\'✓ COPIED!\';document.getElementById(\'nxb\').style.background=\'linear-gradient(135deg,#10B981,#059669)\';setTimeout(()=>{{document.getElementById(\'nxb\').innerText=\'📋 COPY\';document.getElementById(\'nxb\').style.background=\'linear-gradient(135deg,#5B8DEF,#4A7DD9)\';}},2000);}})}}catch(x){{document.execCommand(\'copy\');document.getElementById(\'nxb\').innerText=\'✓ COPIED!\';}}e.style.top=\'-9999px\';" style="width:100%;background:linear-gradient(135deg,#5B8DEF,#4A7DD9);color:#FFF;border:none;border-radius:10px;padding:12px;font-size:13px;font-weight:600;cursor:pointer;transition:all 0.2s;box-shadow:0 2px 8px rgba(91,141,239,0.25)">📋 COPY</button>'
 
-def render_share_panel(q,synth,followups):
+def render_diagnostics(timings):
+    if not timings: return
+    td='style="padding:4px 10px;border-bottom:1px solid #1E2A3E;text-align:right"'; th='style="padding:4px 10px;color:#5A6A7A;text-align:right;font-weight:600"'
+    def row(cells,tag="td"): return "<tr>"+"".join(f"<{tag} {th if tag=='th' else td}>{c}</{tag}>" for c in cells)+"</tr>"
+    def sec(v): return "—" if v is None else f"{v:.2f}s"
+    phases,calls=[],[]
+    for phase,t in timings.items():
+        cs=t.get("calls",[]); ttfts=sorted(c["ttft"] for c in cs if c.get("outcome") in ("ok","cached") and c.get("ttft") is not None)
+        phases.append(row([phase,sec(t["seconds"]),len(cs),sec(ttfts[len(ttfts)//2] if ttfts else None),sum(c.get("input_tokens",0) for c in cs),
+                           sum(c.get("output_tokens",0) for c in cs),sum(c.get("cached_tokens",0) for c in cs),f"{sum(c.get('req_bytes',0)+c.get('resp_bytes',0) for c in cs)/1024:.0f} KB",
+                           sum(c.get("retries",0) for c in cs),sum(1 for c in cs if c.get("fallback"))]))
+        calls+=[row([phase,f"{c['provider']} · {c.get('model','')}",c.get("outcome",""),sec(c.get("wall")),sec(c.get("ttft")),c.get("input_tokens","—"),c.get("output_tokens","—"),
+                     c.get("retries",0),html.escape(c.get("fallback") or "")]) for c in cs]
+    with st.expander("📊  DIAGNOSTICS — where this discussion spent its time",expanded=False):
+        tbl='<table style="width:100%;border-collapse:collapse;font-size:11px;color:#C5D1DE;font-family:JetBrains Mono,monospace;margin-bottom:16px">'
+        st.markdown(tbl+row(["phase","wall","calls","ttft p50","in tok","out tok","cached","bytes","retries","fallbacks"],"th")+"".join(phases)+"</table>"
+                    +tbl+row(["phase","provider · model","outcome","wall","ttft","in","out","retries","fallback"],"th")+"".join(calls)+"</table>",unsafe_allow_html=True)
+        ep=get_metrics().endpoint
+        if ep: st.markdown(f'<div style="font-size:11px;color:#5A6A7A">Prometheus metrics: {html.escape(ep)}</div>',unsafe_allow_html=True)
+        s=_startup()
+        if s["import_s"] is not None: st.markdown(f'<div style="font-size:11px;color:#5A6A7A">Process cold start: module setup {s["import_s"]:.2f}s · first paint {s["first_paint_s"]:.2f}s</div>',unsafe_allow_html=True)
+
+@st.cache_data(max_entries=64,show_spinner=False)
+def _share_payloads(digest,_q,_synth,_followups):
+    fu_text="".join(f"\n\nFOLLOW-UP {i+1}: {fu['question']}\n{fu.get('synthesis','')}" for i,fu in enumerate(_followups))
+    full=f"NEXUS AI — Multi-Model Discussion\n{'='*50}\n\nQUESTION: {_q}\n\nSYNTHESIS:\n{_synth}{fu_text}\n\nGenerated by Nexus AI"
+    short=_synth[:280]+("..." if len(_synth)>280 else "")
+    return {"full":full,"copy":copy_button_html(full),"mail":f"mailto:?subject={urllib.parse.quote(_q[:50])}&body={urllib.parse.quote(full)}",
+            "whatsapp":f"https://wa.me/?text={urllib.parse.quote(f'*Nexus AI*{chr(10)*2}{_q}{chr(10)*2}{short}')}",
+            "twitter":f"https://twitter.com/intent/tweet?text={urllib.parse.quote(f'Q: {_q}{chr(10)*2}{short}{chr(10)*2}#NexusAI')}"}
+
+@st.fragment
+def render_share_panel(disc_id,q,synth,followups):
+    # Payloads for the whole transcript are only built once someone asks to share, then memoized by content
     divider()
     st.markdown('<div style="font-size:13px;font-weight:700;color:#5B8DEF;margin-bottom:16px;letter-spacing:0.02em">📤 Share Discussion</div>',unsafe_allow_html=True)
-    fu_text="".join(f"\n\nFOLLOW-UP {i+1}: {fu['question']}\n{fu.get('synthesis','')}" for i,fu in enumerate(followups))
-    full=f"NEXUS AI — Multi-Model Discussion\n{'='*50}\n\nQUESTION: {q}\n\nSYNTHESIS:\n{synth}{fu_text}\n\nGenerated by Nexus AI"
-    short=synth[:280]+("..." if len(synth)>280 else "")
+    if st.session_state.get("share_open")!=disc_id:
+        if st.button("📤  COPY · DOWNLOAD · EMAIL · WHATSAPP · 𝕏",key="share_open_btn"): st.session_state.share_open=disc_id; st.rerun(scope="fragment")
+        return
+    digest=hashlib.sha1(json.dumps([q,synth,[[fu["question"],fu.get("synthesis","")] for fu in followups]],ensure_ascii=False).encode("utf-8","surrogatepass")).hexdigest()
+    p=_share_payloads(digest,q,synth,followups)
     c1,c2,c3,c4,c5=st.columns(5)
-    with c1: st.components.v1.html(copy_button_html(full),height=52)
-    with c2: st.download_button("⬇ DOWNLOAD",data=full,file_name="nexus.md",mime="text/markdown",use_container_width=True)
-    with c3: st.markdown(f'<a href="mailto:?subject={urllib.parse.quote(q[:50])}&body={urllib.parse.quote(full)}" target="_blank" style="display:block;background:linear-gradient(135deg,#5B8DEF,#4A7DD9);color:#FFF;text-align:center;padding:12px;border-radius:10px;text-decoration:none;font-weight:600;font-size:13px;box-shadow:0 2px 8px rgba(91,141,239,0.25)">📧 EMAIL</a>',unsafe_allow_html=True)
-    with c4: st.markdown(f'<a href="https://wa.me/?text={urllib.parse.quote(f"*Nexus AI*\n\n{q}\n\n{short}")}" target="_blank" style="display:block;background:linear-gradient(135deg,#10B981,#059669);color:#FFF;text-align:center;padding:12px;border-radius:10px;text-decoration:none;font-weight:600;font-size:13px;box-shadow:0 2px 8px rgba(16,185,129,0.25)">💬 WHATSAPP</a>',unsafe_allow_html=True)
-    with c5: st.markdown(f'<a href="https://twitter.com/intent/tweet?text={urllib.parse.quote(f"Q: {q}\n\n{short}\n\n#NexusAI")}" target="_blank" style="display:block;background:linear-gradient(135deg,#3B82F6,#2563EB);color:#FFF;text-align:center;padding:12px;border-radius:10px;text-decoration:none;font-weight:600;font-size:13px;box-shadow:0 2px 8px rgba(59,130,246,0.25)">𝕏 TWITTER</a>',unsafe_allow_html=True)
+    with c1: st.components.v1.html(p["copy"],height=52)
+    with c2: st.download_button("⬇ DOWNLOAD",data=p["full"],file_name="nexus.md",mime="text/markdown",use_container_width=True)
+    with c3: st.markdown(f'<a href="{p["mail"]}" target="_blank" style="display:block;background:linear-gradient(135deg,#5B8DEF,#4A7DD9);color:#FFF;text-align:center;padding:12px;border-radius:10px;text-decoration:none;font-weight:600;font-size:13px;box-shadow:0 2px 8px rgba(91,141,239,0.25)">📧 EMAIL</a>',unsafe_allow_html=True)
+    with c4: st.markdown(f'<a href="{p["whatsapp"]}" target="_blank" style="display:block;background:linear-gradient(135deg,#10B981,#059669);color:#FFF;text-align:center;padding:12px;border-radius:10px;text-decoration:none;font-weight:600;font-size:13px;box-shadow:0 2px 8px rgba(16,185,129,0.25)">💬 WHATSAPP</a>',unsafe_allow_html=True)
+    with c5: st.markdown(f'<a href="{p["twitter"]}" target="_blank" style="display:block;background:linear-gradient(135deg,#3B82F6,#2563EB);color:#FFF;text-align:center;padding:12px;border-radius:10px;text-decoration:none;font-weight:600;font-size:13px;box-shadow:0 2px 8px rgba(59,130,246,0.25)">𝕏 TWITTER</a>',unsafe_allow_html=True)
+
+def _history_item(disc,active_id,snip=""):
+    disc_id=disc.get("id",""); q=disc.get("question","Untitled")[:40]+("..." if len(disc.get("question",""))>40 else "")
+    try: tstr=(disc.get("dt") or _parse_dt(disc.get("created_at",""))).strftime("%H:%M")
+    except: tstr=""
+    fu_c=disc.get("followup_count") or 0; is_active=disc_id==active_id
+    bg="linear-gradient(135deg,rgba(91,141,239,0.12),rgba(91,141,239,0.06))" if is_active else "#0F1419"
+    bl="2px solid #5B8DEF" if is_active else "2px solid transparent"
+    fu_badge=f' <span style="color:#4A5A6A;font-size:10px">+{fu_c}</span>' if fu_c else ""
+    ci,cd=st.columns([5,1])
+    with ci:
+        snip_div=f'<div style="font-size:11px;color:#7A8A9A;margin-top:6px;line-height:1.5">{snippet_html(snip)}</div>' if snip else ""
+        st.markdown(f'<div style="background:{bg};border-left:{bl};padding:12px 14px;border-radius:10px;margin-bottom:6px;cursor:pointer;transition:all 0.2s">'
+                    f'<div style="font-size:12px;color:{"#E1E8F0" if is_active else "#8A9AAA"};font-weight:600;line-height:1.5">{q}</div>{snip_div}'
+                    f'<div style="font-size:10px;color:#4A5A6A;margin-top:4px">{tstr}{fu_badge}</div></div>',unsafe_allow_html=True)
+        if st.button("▶",key=f"open_{disc_id}",help="Resume"):
+            full=get_discussion(disc_id)
+            if full: _load_discussion(full); st.rerun()
+    with cd:
+        if st.button("✕",key=f"del_{disc_id}",help="Delete"):
+            delete_discussion(disc_id)
+            if active_id==disc_id:
+                st.session_state.active_id=None
+            st.rerun()
+
+@st.cache_resource
+def _logo():
+    # Logo should be in same directory as app.py; read once per process
+    try:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)),"dacta.png"),"rb") as f: return f.read()
+    except OSError: return None
 
 def render_history_sidebar():
-    with st.sidebar:
-        # DACTA logo and branding header
-        # Logo should be in same directory as app.py
-        logo_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dacta.png")
-        
-        if os.path.exists(logo_path):
-            col1, col2 = st.columns([0.8, 3.2])
-            with col1:
-                with open(logo_path, "rb") as f:
-                    st.image(f.read(), width=70)
-            with col2:
-                st.markdown('''
-                    <div style="margin-top:-8px">
-                        <div style="font-size:16px;font-weight:700;color:#E1E8F0;letter-spacing:0.02em">Nexus AI</div>
-                        <div style="font-size:9px;color:#5A6A7A;letter-spacing:0.05em;font-weight:600;margin-top:2px">MULTI-MODEL DISCUSSIONS</div>
-                    </div>
-                ''', unsafe_allow_html=True)
-        else:
-            # Fallback without logo
+    with st.sidebar: _sidebar_body()
+
+@st.fragment
+def _sidebar_body():
+    # Searching, paging and changing the range rerun only the sidebar; opening or deleting a discussion reruns the app
+    # DACTA logo and branding header
+    logo = _logo()
+    if logo:
+        col1, col2 = st.columns([0.8, 3.2])
+        with col1:
+            st.image(logo, width=70)
+        with col2:
             st.markdown('''
-                <div style="margin-bottom:20px">
-                    <div style="font-size:16px;font-weight:700;color:#E1E8F0;letter-spacing:0.02em">DACTA Nexus AI</div>
+                <div style="margin-top:-8px">
+                    <div style="font-size:16px;font-weight:700;color:#E1E8F0;letter-spacing:0.02em">Nexus AI</div>
                     <div style="font-size:9px;color:#5A6A7A;letter-spacing:0.05em;font-weight:600;margin-top:2px">MULTI-MODEL DISCUSSIONS</div>
                 </div>
             ''', unsafe_allow_html=True)
-        if st.button("＋  NEW DISCUSSION",use_container_width=True):
-            for k in ["phase","question","r1","r2","synthesis","factcheck","followups","context_summary","active_id"]: st.session_state.pop(k,None)
-            st.rerun()
-        st.markdown('<div style="height:1px;background:#1E2A3E;margin:20px 0"></div>',unsafe_allow_html=True)
-        filter_map={"Today":1,"Last 7 days":7,"Last 30 days":30,"All time":0}
-        sel=st.selectbox("Range",list(filter_map.keys()),index=2,label_visibility="collapsed")
-        history=filter_history(filter_map[sel])
-        if not history:
-            st.markdown('<div style="font-size:12px;color:#4A5A6A;padding:16px 0">No discussions yet.<br>Start one above!</div>',unsafe_allow_html=True); return
-        groups=group_by_date(history); active_id=st.session_state.get("active_id","")
-        for gname,items in groups.items():
-            if not items: continue
-            st.markdown(f'<div style="font-size:10px;color:#4A5A6A;letter-spacing:0.08em;font-weight:700;margin:20px 0 10px 0">{gname.upper()}</div>',unsafe_allow_html=True)
-            for disc in items:
-                disc_id=disc.get("id",""); q=disc.get("question","Untitled")[:40]+("..." if len(disc.get("question",""))>40 else "")
-                try: tstr=_parse_dt(disc.get("created_at","")).strftime("%H:%M")
-                except: tstr=""
-                fu_c=len(disc.get("followups",[])); is_active=disc_id==active_id
-                bg="linear-gradient(135deg,rgba(91,141,239,0.12),rgba(91,141,239,0.06))" if is_active else "#0F1419"
-                bl="2px solid #5B8DEF" if is_active else "2px solid transparent"
-                fu_badge=f' <span style="color:#4A5A6A;font-size:10px">+{fu_c}</span>' if fu_c else ""
-                ci,cd=st.columns([5,1])
-                with ci:
-                    st.markdown(f'<div style="background:{bg};border-left:{bl};padding:12px 14px;border-radius:10px;margin-bottom:6px;cursor:pointer;transition:all 0.2s">'
-                                f'<div style="font-size:12px;color:{"#E1E8F0" if is_active else "#8A9AAA"};font-weight:600;line-height:1.5">{q}</div>'
-                                f'<div style="font-size:10px;color:#4A5A6A;margin-top:4px">{tstr}{fu_badge}</div></div>',unsafe_allow_html=True)
-                    if st.button("▶",key=f"open_{disc_id}",help="Resume"): _load_discussion(disc); st.rerun()
-                with cd:
-                    if st.button("✕",key=f"del_{disc_id}",help="Delete"):
-                        delete_discussion(disc_id)
-                        if active_id==disc_id:
-                            for k in ["phase","question","r1","r2","synthesis","factcheck","followups","active_id"]: st.session_state.pop(k,None)
-                        st.rerun()
-        mode_col="#10B981" if STORAGE_MODE=="supabase" else "#A78BFA"
-        mode_txt="☁ Supabase (cloud)" if STORAGE_MODE=="supabase" else "💾 Local JSON"
-        st.markdown(f'<div style="margin-top:24px;padding-top:16px;border-top:1px solid #1E2A3E"><div style="font-size:11px;color:{mode_col};font-weight:600">{mode_txt}</div></div>',unsafe_allow_html=True)
+    else:
+        # Fallback without logo
+        st.markdown('''
+            <div style="margin-bottom:20px">
+                <div style="font-size:16px;font-weight:700;color:#E1E8F0;letter-spacing:0.02em">DACTA Nexus AI</div>
+                <div style="font-size:9px;color:#5A6A7A;letter-spacing:0.05em;font-weight:600;margin-top:2px">MULTI-MODEL DISCUSSIONS</div>
+            </div>
+        ''', unsafe_allow_html=True)
+    if st.button("＋  NEW DISCUSSION",use_container_width=True):
+        st.session_state.active_id=None
+        st.rerun()
+    st.markdown('<div style="height:1px;background:#1E2A3E;margin:20px 0"></div>',unsafe_allow_html=True)
+    query=st.text_input("Search",placeholder="🔍 Search discussions...",label_visibility="collapsed",key="hist_search")
+    if query.strip():
+        results=search_history(query); active_id=st.session_state.get("active_id","")
+        st.markdown(f'<div style="font-size:10px;color:#4A5A6A;letter-spacing:0.08em;font-weight:700;margin:20px 0 10px 0">{len(results)} RESULT{"" if len(results)==1 else "S"}</div>',unsafe_allow_html=True)
+        for disc in results: _history_item(disc,active_id,disc.get("snippet",""))
+        return
+    filter_map={"Today":1,"Last 7 days":7,"Last 30 days":30,"All time":0}
+    sel=st.selectbox("Range",list(filter_map.keys()),index=2,label_visibility="collapsed")
+    if st.session_state.get("hist_range")!=sel: st.session_state.hist_range=sel; st.session_state.hist_pages=1
+    history=filter_history(filter_map[sel],st.session_state.hist_pages)
+    if not history:
+        st.markdown('<div style="font-size:12px;color:#4A5A6A;padding:16px 0">No discussions yet.<br>Start one above!</div>',unsafe_allow_html=True); return
+    groups=group_by_date(history); active_id=st.session_state.get("active_id","")
+    for gname,items in groups.items():
+        if not items: continue
+        st.markdown(f'<div style="font-size:10px;color:#4A5A6A;letter-spacing:0.08em;font-weight:700;margin:20px 0 10px 0">{gname.upper()}</div>',unsafe_allow_html=True)
+        for disc in items: _history_item(disc,active_id)
+    if len(history)>=HISTORY_PAGE*st.session_state.hist_pages and st.button("Load more",use_container_width=True):
+        st.session_state.hist_pages+=1; st.rerun(scope="fragment")
+    mode_col="#10B981" if STORAGE_MODE=="supabase" else "#A78BFA"
+    mode_txt="☁ Supabase (cloud)" if STORAGE_MODE=="supabase" else "💾 Local SQLite"
+    st.markdown(f'<div style="margin-top:24px;padding-top:16px;border-top:1px solid #1E2A3E"><div style="font-size:11px;color:{mode_col};font-weight:600">{mode_txt}</div>'
+                f'<div style="font-size:10px;color:#4A5A6A;margin-top:4px">{get_engine().cache.summary()}{get_engine().prompt_cache_summary()}{get_bodies().summary()}{get_persist_queue().summary()}</div></div>',unsafe_allow_html=True)
 
 def _load_discussion(disc):
-    for k,v in [("active_id",disc.get("id","")),("phase",disc.get("phase",4)),("question",disc.get("question","")),
-                ("r1",disc.get("r1",{})),("r2",disc.get("r2",{})),("synthesis",disc.get("synthesis","")),("factcheck",disc.get("factcheck","")),
-                ("followups",disc.get("followups",[])),("context_summary",disc.get("context_summary",""))]:
-        st.session_state[k]=v
+    # The session keeps only the id; the body goes to the shared cache
+    get_bodies().put(disc); st.session_state.active_id=disc.get("id")
+
+def _active_discussion():
+    # This session's discussion body, reloaded from storage if the shared cache evicted it
+    disc_id=st.session_state.get("active_id")
+    if not disc_id: return None
+    disc=get_bodies().get(disc_id)
+    if disc is None:
+        disc=get_discussion(disc_id)
+        if disc is None: st.session_state.active_id=None; return None
+        get_bodies().put(disc)
+    return disc
 
 def _current_discussion():
-    return {"id":st.session_state.get("active_id",str(uuid.uuid4())),"created_at":st.session_state.get("created_at",datetime.now(timezone.utc).replace(tzinfo=None).isoformat()),
-            "question":st.session_state.get("question",""),"phase":st.session_state.get("phase",0),"r1":st.session_state.get("r1",{}),"r2":st.session_state.get("r2",{}),
-            "synthesis":st.session_state.get("synthesis",""),"factcheck":st.session_state.get("factcheck",""),"followups":st.session_state.get("followups",[]),
-            "context_summary":st.session_state.get("context_summary","")}
+    # A private copy to hand to a job, which mutates what it is given
+    return copy.deepcopy(_active_discussion())
 
 def init_state():
-    for k,v in {"phase":0,"question":"","r1":{},"r2":{},"synthesis":None,"factcheck":None,"followups":[],"context_summary":"","active_id":None,"created_at":None}.items():
-        if k not in st.session_state: st.session_state[k]=v
-
-def main():
-    init_state(); render_history_sidebar(); key_status_banner()
-    if not ANTHROPIC_KEY: st.error("ANTHROPIC_API_KEY required"); st.stop()
+    if "sid" not in st.session_state: st.session_state.sid=str(uuid.uuid4())
+    if "active_id" not in st.session_state: st.session_state.active_id=None
 
+@st.fragment
+def render_composer():
+    # Typing, attaching context and flipping options rerun only this block; starting a discussion reruns the app
     text_context,image_data,context_summary=render_context_panel()
     question=st.text_area("Question",placeholder="Ask anything — multiple AIs will discuss and synthesize the answer...",height=100,label_visibility="collapsed")
     c1,c2=st.columns([1,4])
@@ -486,9 +2152,39 @@ def main():
     with c2:
         note=f"Context: {context_summary} · " if context_summary else ""
         st.markdown(f'<div style="color:#5A6A7A;font-size:12px;padding-top:12px">{note}5 models · parallel reasoning · adversarial fact-check</div>',unsafe_allow_html=True)
+    c1,c2=st.columns([3,1])
+    with c1: adaptive=st.toggle("⚡ Adaptive debate — skip or shorten round 2 when the first answers already agree",value=ADAPTIVE["enabled"],key="adaptive_rounds")
+    with c2: profile=st.radio("Models",list(TIER_PROFILES),format_func=str.title,horizontal=True,key="model_profile",label_visibility="collapsed",
+                              help="Fast uses small models for the answers and debate and keeps the large model for the synthesis")
+    if start and question.strip():
+        disc={"id":str(uuid.uuid4()),"created_at":datetime.now(timezone.utc).replace(tzinfo=None).isoformat(),"question":question.strip(),"phase":1,"r1":{},"r2":{},
+              "synthesis":None,"factcheck":None,"followups":[],"context_summary":context_summary,"rolling_summary":None,"fallbacks":{},"profile":profile,
+              "job":{"text_context":text_context,"images":image_data,"adaptive":adaptive}}
+        _load_discussion(get_job_runner().submit(disc,st.session_state.sid).snapshot()); st.rerun()
+
+@st.fragment
+def render_followup_composer(n):
+    fu_q=st.text_input("fu",placeholder="Ask a follow-up, challenge the synthesis, request clarification...",label_visibility="collapsed",key=f"fu_{n}")
+    with st.expander("📎  Attach context to follow-up",expanded=False):
+        st.markdown('<div style="font-size:12px;color:#5A6A7A;margin-bottom:12px">Add files, images, or a URL for this follow-up.</div>',unsafe_allow_html=True)
+        fu_text_ctx,fu_image_data,fu_ctx_summary=render_context_inputs(f"fu_{n}")
+    if fu_ctx_summary:
+        st.markdown(f'<div style="font-size:12px;color:#10B981;background:rgba(16,185,129,0.08);border:1px solid rgba(16,185,129,0.3);border-radius:10px;padding:10px 14px;margin-bottom:12px;font-weight:600">✓ {fu_ctx_summary}</div>',unsafe_allow_html=True)
+    if st.button("▶  SEND FOLLOW-UP",key=f"send_{n}") and fu_q.strip():
+        disc=_current_discussion()
+        disc["pending_followup"]={"question":fu_q.strip(),"text_context":fu_text_ctx or "","images":fu_image_data or [],"context_summary":fu_ctx_summary}
+        _load_discussion(get_job_runner().submit(disc,st.session_state.sid).snapshot()); st.rerun()
+
+def main():
+    setup_page(); init_state(); _SESSION.set(st.session_state.sid); render_history_sidebar(); key_status_banner()
+    if not ANTHROPIC_KEY: st.error("ANTHROPIC_API_KEY required"); st.stop()
+    render_composer()
     divider()
 
-    if st.session_state.phase==0 and not start:
+    runner=get_job_runner()
+    job=runner.get(st.session_state.active_id) if st.session_state.active_id else None
+    d=_active_discussion()
+    if d is None:
         st.markdown('<div style="background:linear-gradient(135deg,#0F1419,#0D1117);border-radius:16px;border:1px solid #1E2A3E;padding:32px;text-align:center">'
                     '<div style="font-size:11px;color:#4A5A6A;letter-spacing:0.08em;font-weight:700;margin-bottom:20px">PARTICIPATING MODELS</div>'
                     '<div style="display:flex;justify-content:center;gap:32px;flex-wrap:wrap;margin-bottom:24px">'
@@ -500,131 +2196,102 @@ def main():
                     '</div><div style="border-top:1px solid #1E2A3E;padding-top:20px;font-size:12px;color:#5A6A7A">← History in sidebar · Click any discussion to resume</div></div>',unsafe_allow_html=True)
         return
 
-    if start and question.strip():
-        disc_id=str(uuid.uuid4())
-        st.session_state.update({"phase":1,"question":question.strip(),"r1":{},"r2":{},"synthesis":None,"factcheck":None,
-                                  "followups":[],"context_summary":context_summary,"active_id":disc_id,"created_at":datetime.now(timezone.utc).replace(tzinfo=None).isoformat()})
-
-    q=st.session_state.question
+    # A running job refreshes the cached body at each checkpoint; the step in flight is drawn from its live state
+    running=bool(job and not job.done); step=job.live()["step"] if running else None
+    q=d.get("question","")
     if not q: return
-    def with_ctx(msg): return text_context+msg if text_context else msg
+    phase,r1,r2,fallbacks,followups=d.get("phase",4),d.get("r1") or {},d.get("r2") or {},d.get("fallbacks") or {},d.get("followups") or []
+    if not running and next_step(d):
+        why=f"Stopped: {html.escape(job.error)}" if job and job.error else "This discussion was interrupted before it finished."
+        st.markdown(f'<div style="font-size:12px;color:#F59E0B;background:rgba(245,158,11,0.08);border:1px solid rgba(245,158,11,0.3);border-radius:10px;padding:10px 14px;margin-bottom:12px;font-weight:600">{why}</div>',unsafe_allow_html=True)
+        if st.button("↻  RESUME",key="resume"): _load_discussion(runner.submit(_current_discussion(),st.session_state.sid).snapshot()); st.rerun()
+    unsaved=get_persist_queue().dropped.get(d["id"])
+    if unsaved:
+        st.markdown(f'<div style="font-size:12px;color:#EF4444;background:rgba(239,68,68,0.08);border:1px solid rgba(239,68,68,0.3);border-radius:10px;padding:10px 14px;margin-bottom:12px;font-weight:600">'
+                    f'Not saved to history: {html.escape(unsaved[1])}</div>',unsafe_allow_html=True)
+        if st.button("↻  RETRY SAVE",key="retry_save"): get_persist_queue().retry(d["id"]); st.rerun()
 
     # Round 1
-    phase_header(1,"Initial Responses — Each AI answers independently","done" if st.session_state.phase>1 else "active")
-    if not st.session_state.r1:
-        cols=st.columns(5)
-        for i,p in enumerate(PERSONAS_ORDER): cols[i].markdown(ai_card_html(p,"⟳ Thinking...","ROUND 1"),unsafe_allow_html=True)
-        with st.spinner("Round 1 — all 5 models answering..."): results=run_parallel([(p,"initial",with_ctx(q),image_data) for p in PERSONAS_ORDER])
-        st.session_state.r1=dict(zip(PERSONAS_ORDER,results)); st.session_state.phase=2; save_discussion(_current_discussion()); st.rerun()
+    phase_header(1,"Initial Responses — Each AI answers independently","done" if phase>1 else "active")
+    if not r1:
+        if step=="r1": _follow_job(job,_live_cards("ROUND 1"))
+        return
     cols=st.columns(5)
-    for i,p in enumerate(PERSONAS_ORDER): cols[i].markdown(ai_card_html(p,st.session_state.r1[p],"ROUND 1"),unsafe_allow_html=True)
+    for i,p in enumerate(PERSONAS_ORDER): cols[i].markdown(memo_html(ai_card_html,r1[p],persona=p,label="ROUND 1",fallback=fallbacks.get("r1",{}).get(p)),unsafe_allow_html=True)
     divider()
 
     # Round 2
-    phase_header(2,"Open Debate — Each AI critiques and builds on the others","done" if st.session_state.phase>2 else "active")
-    def make_debate(me):
-        others=[p for p in PERSONAS_ORDER if p!=me]
-        return with_ctx(f'Original: "{q}"\n\nMY ANSWER:\n{st.session_state.r1[me]}\n\n'+"\n\n".join(f"{AI_CONFIG[o]['name'].upper()}:\n{st.session_state.r1[o]}" for o in others)+"\n\nEngage genuinely. Agree, challenge, extend.")
-    if not st.session_state.r2:
+    phase_header(2,"Open Debate — Each AI critiques and builds on the others","done" if phase>2 else "active")
+    plan=d.get("adaptive") or {}; debaters=plan.get("personas") or PERSONAS_ORDER
+    if plan.get("mode") in ("skip","subset"):
+        what="Debate skipped" if plan["mode"]=="skip" else "Short debate: "+", ".join(AI_CONFIG[p]["name"] for p in debaters)
+        st.markdown(f'<div style="font-size:12px;color:#A78BFA;background:rgba(167,139,250,0.08);border:1px solid rgba(167,139,250,0.3);border-radius:10px;padding:10px 14px;margin-bottom:12px;font-weight:600">'
+                    f'⚡ {what} — round-1 agreement {plan["score"]:.2f}</div>',unsafe_allow_html=True)
+    if plan.get("mode")!="skip":
+        if not r2:
+            if step=="r2": _follow_job(job,_live_cards("ROUND 2","⟳ Reading others...",debaters))
+            return
         cols=st.columns(5)
-        for i,p in enumerate(PERSONAS_ORDER): cols[i].markdown(ai_card_html(p,"⟳ Reading others...","ROUND 2"),unsafe_allow_html=True)
-        with st.spinner("Round 2 — all 5 models debating..."): results=run_parallel([(p,"debate",make_debate(p),None) for p in PERSONAS_ORDER])
-        st.session_state.r2=dict(zip(PERSONAS_ORDER,results)); st.session_state.phase=3; save_discussion(_current_discussion()); st.rerun()
-    cols=st.columns(5)
-    for i,p in enumerate(PERSONAS_ORDER): cols[i].markdown(ai_card_html(p,st.session_state.r2[p],"ROUND 2"),unsafe_allow_html=True)
+        for i,p in enumerate(PERSONAS_ORDER): cols[i].markdown(memo_html(ai_card_html,r2.get(p,SAT_OUT),persona=p,label="ROUND 2",fallback=fallbacks.get("r2",{}).get(p)),unsafe_allow_html=True)
     divider()
 
     # Synthesis
-    phase_header(3,"Final Synthesis — Best answer from all five voices","done" if st.session_state.phase>=4 else "active")
-    if not st.session_state.synthesis:
-        sp=f'QUESTION: "{q}"\n\nROUND 1:\n'+"\n\n".join(f"[{AI_CONFIG[p]['name']}]\n{st.session_state.r1[p]}" for p in PERSONAS_ORDER)+"\n\nROUND 2:\n"+"\n\n".join(f"[{AI_CONFIG[p]['name']}]\n{st.session_state.r2[p]}" for p in PERSONAS_ORDER)+"\n\nSynthesize."
-        with st.spinner("Synthesizing..."): st.session_state.synthesis=call_claude(SYNTH_SYSTEM,sp)
-        st.session_state.phase=4; save_discussion(_current_discussion()); st.rerun()
-    safe=st.session_state.synthesis.replace("&","&amp;").replace("<","&lt;").replace(">","&gt;")
-    st.markdown(f'<div style="background:linear-gradient(135deg,rgba(16,185,129,0.08),rgba(16,185,129,0.04));border:2px solid rgba(16,185,129,0.4);border-radius:16px;padding:32px;box-shadow:0 4px 16px rgba(16,185,129,0.15)">'
-                f'<div style="display:flex;align-items:center;gap:16px;margin-bottom:20px">'
-                f'<div style="width:40px;height:40px;border-radius:50%;background:linear-gradient(135deg,#10B981,#059669);display:flex;align-items:center;justify-content:center;font-size:20px">✦</div>'
-                f'<div><div style="font-size:16px;font-weight:700;color:#10B981;letter-spacing:0.02em">SYNTHESIZED ANSWER</div>'
-                f'<div style="font-size:11px;color:#5A6A7A;font-weight:600;margin-top:2px">Claude · Gemini · GPT-4 · Perplexity · DeepSeek</div></div></div>'
-                f'<div style="color:#C5D1DE;font-size:14.5px;line-height:1.9;white-space:pre-wrap">{safe}</div></div>',unsafe_allow_html=True)
+    phase_header(3,"Final Synthesis — Best answer from all five voices","done" if phase>=4 else "active")
+    if not d.get("synthesis"):
+        if step=="synthesis": _follow_job(job,_live_text(synthesis_html))
+        return
+    st.markdown(memo_html(synthesis_html,d.get("synthesis")),unsafe_allow_html=True)
 
     # Fact-check
-    if st.session_state.phase>=4 and not st.session_state.factcheck:
-        fc_prompt=f'QUESTION: "{q}"\n\nSYNTHESIS:\n{st.session_state.synthesis}\n\nFact-check with skepticism. Verify claims, flag hallucinations, cite sources. 2-3 paragraphs.'
-        try:
-            with st.spinner("🔍 Perplexity fact-checking..."):
-                if PERPLEXITY_KEY:
-                    try:
-                        st.session_state.factcheck=call_perplexity(FACTCHECK_SYSTEM,fc_prompt)
-                    except Exception:
-                        st.session_state.factcheck=call_claude(FACTCHECK_SYSTEM,fc_prompt)
-                else:
-                    st.session_state.factcheck=call_claude(FACTCHECK_SYSTEM,fc_prompt)
-        except Exception as e:
-            st.session_state.factcheck=f"Fact-check unavailable: {str(e)[:100]}"
-        save_discussion(_current_discussion()); st.rerun()
-    if st.session_state.factcheck:
-        fc_source = "PERPLEXITY" if (PERPLEXITY_KEY and "unavailable" not in st.session_state.factcheck.lower()) else "CLAUDE"
-        with st.expander(f"🔍  FACT-CHECK — Adversarial verification ({fc_source})",expanded=False):
-            safe_fc=st.session_state.factcheck.replace("&","&amp;").replace("<","&lt;").replace(">","&gt;")
-            st.markdown(f'<div style="background:linear-gradient(135deg,rgba(251,191,36,0.08),rgba(251,191,36,0.04));border:1.5px solid rgba(251,191,36,0.4);border-radius:12px;padding:24px">'
-                       f'<div style="color:#FBB020;font-size:11px;font-weight:700;letter-spacing:0.08em;margin-bottom:12px">⚠ {fc_source} VERIFICATION</div>'
-                       f'<div style="color:#C5D1DE;font-size:13px;line-height:1.8;white-space:pre-wrap">{safe_fc}</div></div>',unsafe_allow_html=True)
+    if not d.get("factcheck"):
+        if step=="factcheck": _follow_job(job,_live_text(lambda t:factcheck_html(t,"PERPLEXITY" if PERPLEXITY_KEY else "CLAUDE")))
+        return
+    fc_source = "PERPLEXITY" if (PERPLEXITY_KEY and "unavailable" not in d.get("factcheck").lower()) else "CLAUDE"
+    with st.expander(f"🔍  FACT-CHECK — Adversarial verification ({fc_source})",expanded=False):
+        st.markdown(memo_html(factcheck_html,d.get("factcheck"),source=fc_source),unsafe_allow_html=True)
 
     # Follow-ups
-    if st.session_state.phase>=4:
-        divider()
-        st.markdown('<div style="font-size:15px;font-weight:700;color:#5B8DEF;margin-bottom:16px;letter-spacing:0.02em">💬 Continue Discussion</div>',unsafe_allow_html=True)
-        for i,fu in enumerate(st.session_state.followups):
-            with st.expander(f"↩ Follow-up {i+1}: {fu['question'][:50]}{'...' if len(fu['question'])>50 else ''}",expanded=(i==len(st.session_state.followups)-1)):
+    divider()
+    st.markdown('<div style="font-size:15px;font-weight:700;color:#5B8DEF;margin-bottom:16px;letter-spacing:0.02em">💬 Continue Discussion</div>',unsafe_allow_html=True)
+    for i,fu in enumerate(followups):
+        with st.expander(f"↩ Follow-up {i+1}: {fu['question'][:50]}{'...' if len(fu['question'])>50 else ''}",expanded=(i==len(followups)-1)):
+            cols=st.columns(5)
+            for j,p in enumerate(PERSONAS_ORDER): cols[j].markdown(memo_html(ai_card_html,fu["responses"].get(p,""),persona=p,label="FOLLOW-UP",fallback=fu.get("fallbacks",{}).get(p)),unsafe_allow_html=True)
+            if fu.get("synthesis"): st.markdown(memo_html(fu_synthesis_html,fu["synthesis"]),unsafe_allow_html=True)
+            # Follow-up fact-check
+            if fu.get("factcheck"):
+                with st.expander("🔍  Follow-up fact-check",expanded=False): st.markdown(memo_html(factcheck_html,fu["factcheck"],padding=20),unsafe_allow_html=True)
+    n=len(followups); pf=d.get("pending_followup")
+    if pf:
+        with st.expander(f"↩ Follow-up {n+1}: {pf['question'][:50]}{'...' if len(pf['question'])>50 else ''}",expanded=True):
+            if pf.get("responses"):
                 cols=st.columns(5)
-                for j,p in enumerate(PERSONAS_ORDER): cols[j].markdown(ai_card_html(p,fu["responses"].get(p,""),"FOLLOW-UP"),unsafe_allow_html=True)
-                if fu.get("synthesis"):
-                    sfu=fu["synthesis"].replace("&","&amp;").replace("<","&lt;").replace(">","&gt;")
-                    st.markdown(f'<div style="background:linear-gradient(135deg,rgba(91,141,239,0.08),rgba(91,141,239,0.04));border:1.5px solid rgba(91,141,239,0.4);border-radius:12px;padding:24px;margin-top:16px">'
-                                f'<div style="font-size:13px;font-weight:700;color:#5B8DEF;margin-bottom:12px">↩ UPDATED SYNTHESIS</div>'
-                                f'<div style="color:#C5D1DE;font-size:13.5px;line-height:1.8;white-space:pre-wrap">{sfu}</div></div>',unsafe_allow_html=True)
-                # Follow-up fact-check
-                if fu.get("factcheck"):
-                    with st.expander("🔍  Follow-up fact-check",expanded=False):
-                        safe_fufc=fu["factcheck"].replace("&","&amp;").replace("<","&lt;").replace(">","&gt;")
-                        st.markdown(f'<div style="background:linear-gradient(135deg,rgba(251,191,36,0.08),rgba(251,191,36,0.04));border:1.5px solid rgba(251,191,36,0.4);border-radius:12px;padding:20px">'
-                                   f'<div style="color:#FBB020;font-size:11px;font-weight:700;letter-spacing:0.08em;margin-bottom:10px">⚠ VERIFICATION</div>'
-                                   f'<div style="color:#C5D1DE;font-size:13px;line-height:1.8;white-space:pre-wrap">{safe_fufc}</div></div>',unsafe_allow_html=True)
-        n=len(st.session_state.followups)
-        fu_q=st.text_input("fu",placeholder="Ask a follow-up, challenge the synthesis, request clarification...",label_visibility="collapsed",key=f"fu_{n}")
-        with st.expander("📎  Attach context to follow-up",expanded=False):
-            st.markdown('<div style="font-size:12px;color:#5A6A7A;margin-bottom:12px">Add files, images, or a URL for this follow-up.</div>',unsafe_allow_html=True)
-            fu_text_ctx,fu_image_data,fu_ctx_summary=render_context_inputs(f"fu_{n}")
-        if fu_ctx_summary:
-            st.markdown(f'<div style="font-size:12px;color:#10B981;background:rgba(16,185,129,0.08);border:1px solid rgba(16,185,129,0.3);border-radius:10px;padding:10px 14px;margin-bottom:12px;font-weight:600">✓ {fu_ctx_summary}</div>',unsafe_allow_html=True)
-        if st.button("▶  SEND FOLLOW-UP",key=f"send_{n}") and fu_q.strip():
-            hctx=f'ORIGINAL: "{q}"\n\nSYNTHESIS:\n{st.session_state.synthesis}\n\n'+("PRIOR:\n"+"".join(f"Q{i+1}: {fu['question']}\nA: {fu.get('synthesis','')}\n\n" for i,fu in enumerate(st.session_state.followups)) if st.session_state.followups else "")+f'NEW: "{fu_q.strip()}"'
-            if fu_text_ctx: hctx=fu_text_ctx+hctx
-            with st.spinner("All 5 models responding..."): fu_results=run_parallel([(p,"followup",hctx,fu_image_data if fu_image_data else None) for p in PERSONAS_ORDER])
-            fu_map=dict(zip(PERSONAS_ORDER,fu_results))
-            fu_sp=hctx+"\n\nRESPONSES:\n"+"\n\n".join(f"[{AI_CONFIG[p]['name']}]\n{fu_map[p]}" for p in PERSONAS_ORDER)+"\n\nSynthesize."
-            with st.spinner("Synthesizing..."): fu_synth=call_claude(FOLLOWUP_SYNTH_SYSTEM,fu_sp)
-            # Fact-check follow-up synthesis
-            fu_fc_prompt=f'ORIGINAL: "{q}"\n\nFOLLOW-UP: "{fu_q.strip()}"\n\nFOLLOW-UP SYNTHESIS:\n{fu_synth}\n\nFact-check this follow-up response. Verify claims, cite sources. 2 paragraphs.'
-            try:
-                with st.spinner("🔍 Fact-checking follow-up..."):
-                    if PERPLEXITY_KEY:
-                        try:
-                            fu_factcheck=call_perplexity(FACTCHECK_SYSTEM,fu_fc_prompt)
-                        except Exception:
-                            fu_factcheck=call_claude(FACTCHECK_SYSTEM,fu_fc_prompt)
-                    else:
-                        fu_factcheck=call_claude(FACTCHECK_SYSTEM,fu_fc_prompt)
-            except Exception as e:
-                fu_factcheck=f"Fact-check unavailable: {str(e)[:100]}"
-            st.session_state.followups.append({"question":fu_q.strip(),"responses":fu_map,"synthesis":fu_synth,"factcheck":fu_factcheck,"context_summary":fu_ctx_summary})
-            save_discussion(_current_discussion()); st.rerun()
-
-        render_share_panel(q,st.session_state.synthesis,st.session_state.followups)
-        st.markdown('<div style="margin-top:32px"></div>',unsafe_allow_html=True)
-        if st.button("↺  NEW DISCUSSION"):
-            for k in ["phase","question","r1","r2","synthesis","factcheck","followups","context_summary","active_id","created_at"]: st.session_state.pop(k,None)
-            st.rerun()
+                for j,p in enumerate(PERSONAS_ORDER): cols[j].markdown(memo_html(ai_card_html,pf["responses"].get(p,""),persona=p,label="FOLLOW-UP",fallback=pf.get("fallbacks",{}).get(p)),unsafe_allow_html=True)
+            elif step=="fu_responses": _follow_job(job,_live_cards("FOLLOW-UP"))
+            if pf.get("synthesis"): st.markdown(memo_html(fu_synthesis_html,pf["synthesis"]),unsafe_allow_html=True)
+            elif step=="fu_synthesis": _follow_job(job,_live_text(fu_synthesis_html))
+            if step=="fu_factcheck": _follow_job(job,_live_text(lambda t:factcheck_html(t,padding=20)))
+        return
+    render_followup_composer(n)
+
+    render_diagnostics(d.get("timings") or {})
+    render_share_panel(st.session_state.active_id,q,d.get("synthesis"),followups)
+    st.markdown('<div style="margin-top:32px"></div>',unsafe_allow_html=True)
+    if st.button("↺  NEW DISCUSSION"): st.session_state.active_id=None; st.rerun()
+
+# ─── Startup timing: module setup per run, and the process's cold start ───
+SETUP_BUCKETS = (0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5)
+
+@st.cache_resource
+def _startup():
+    return {"import_s":None,"first_paint_s":None}
+
+def record_run(setup_s,total_s):
+    # The first run in a process is its cold start; every run's module setup goes to a histogram
+    s=_startup(); get_metrics().observe("nexus_script_setup_seconds",setup_s,buckets=SETUP_BUCKETS)
+    if s["import_s"] is None: s.update(import_s=round(setup_s,3),first_paint_s=round(total_s,3))
 
-if __name__=="__main__": main()
+if __name__=="__main__":
+    _setup_s=time.perf_counter()-_RUN_T0
+    try: main()
+    finally: record_run(_setup_s,time.perf_counter()-_RUN_T0)
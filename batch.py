@@ -0,0 +1,91 @@
+# Headless batch runs: the app's debate → synthesis → fact-check pipeline driven from a JSONL file.
+#   python batch.py questions.jsonl -o results.jsonl --concurrency 8
+# Each input line is {"question": ..., "id"?: ..., "urls"?: [...], "files"?: [paths]} or a bare JSON string.
+# Results are appended as each discussion finishes. Rerunning with the same output skips finished ids, and
+# discussions interrupted part-way resume from their last saved step.
+import argparse
+import concurrent.futures
+import json
+import mimetypes
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+
+import app
+
+def load_items(path):
+    items=[]
+    with open(path,encoding="utf-8") as f:
+        for n,line in enumerate(f,1):
+            line=line.strip()
+            if not line: continue
+            item=json.loads(line)
+            if isinstance(item,str): item={"question":item}
+            if not str(item.get("question","")).strip(): raise SystemExit(f"{path}:{n}: missing question")
+            # A stable id lets a rerun find the discussion this line saved last time
+            item.setdefault("id",str(uuid.uuid5(uuid.NAMESPACE_URL,f"nexus-batch:{n}:{item['question']}")))
+            items.append(item)
+    return items
+
+def finished_ids(path):
+    done=set()
+    try:
+        with open(path,encoding="utf-8") as f:
+            for line in f:
+                try: rec=json.loads(line)
+                except ValueError: continue   # a line cut short by a crash
+                if not rec.get("error"): done.add(rec.get("id"))
+    except FileNotFoundError: pass
+    return done
+
+def _files(item):
+    out=[]
+    for p in item.get("files") or []:
+        with open(p,"rb") as f: out.append((os.path.basename(p),mimetypes.guess_type(p)[0] or "text/plain",f.read()))
+    return out
+
+def run_one(item,profile=app.DEFAULT_PROFILE):
+    t0=time.monotonic(); files=_files(item); disc=app.get_discussion(item["id"])
+    if disc is None:
+        text_context,image_data,summary=app.build_context(files,item.get("urls") or [])
+        disc={"id":item["id"],"created_at":datetime.now(timezone.utc).replace(tzinfo=None).isoformat(),"question":item["question"].strip(),"phase":1,
+              "r1":{},"r2":{},"synthesis":None,"factcheck":None,"followups":[],"context_summary":summary,"rolling_summary":None,"fallbacks":{},"profile":profile,
+              "job":{"text_context":text_context,"images":image_data}}
+        app.save_discussion(disc)
+    else:
+        # Re-adding the same bytes restores any image the saved job refers to that is no longer on disk
+        for name,media_type,fb in files:
+            if media_type.startswith("image/"): app.get_image_store().add(fb,media_type)
+    job=app.DiscussionJob(disc,"batch"); images=app.get_image_store(); images.pin(job.images)
+    try: job.run()
+    finally: images.unpin(job.images)
+    disc=job.snapshot(); images.discard(job.images)
+    return {"id":disc["id"],"question":disc["question"],"synthesis":disc["synthesis"],"factcheck":disc["factcheck"],"r1":disc["r1"],"r2":disc.get("r2") or {},
+            "adaptive":disc.get("adaptive"),"profile":disc.get("profile"),"fallbacks":disc.get("fallbacks",{}),"context_summary":disc.get("context_summary",""),"seconds":round(time.monotonic()-t0,1)}
+
+def main(argv=None):
+    ap=argparse.ArgumentParser(description="Run Nexus discussions headlessly from a JSONL file of questions.")
+    ap.add_argument("input",help="JSONL file, one question per line")
+    ap.add_argument("-o","--output",help="results JSONL (default: <input>.results.jsonl); reused to resume")
+    ap.add_argument("-c","--concurrency",type=int,default=4,help="discussions in flight at once (default 4)")
+    ap.add_argument("--profile",choices=list(app.TIER_PROFILES),default=app.DEFAULT_PROFILE,help="model tier profile for new discussions (default quality)")
+    args=ap.parse_args(argv)
+    if not app.ANTHROPIC_KEY: raise SystemExit("ANTHROPIC_API_KEY required (environment or .streamlit/secrets.toml)")
+    out=args.output or os.path.splitext(args.input)[0]+".results.jsonl"
+    items=load_items(args.input); done=finished_ids(out); todo=[i for i in items if i["id"] not in done]
+    print(f"{len(items)} questions, {len(items)-len(todo)} already done, running {len(todo)} at concurrency {args.concurrency}",file=sys.stderr)
+    failed=0; t0=time.monotonic()
+    with open(out,"a",encoding="utf-8") as f, concurrent.futures.ThreadPoolExecutor(max(1,args.concurrency)) as pool:
+        futs={pool.submit(run_one,i,args.profile):i for i in todo}
+        for n,fut in enumerate(concurrent.futures.as_completed(futs),1):
+            item=futs[fut]
+            try: rec=fut.result(); status=f"{rec['seconds']}s"
+            except Exception as e: rec={"id":item["id"],"question":item["question"],"error":str(e)[:300]}; status=f"failed: {rec['error'][:80]}"; failed+=1
+            f.write(json.dumps(rec,ensure_ascii=False)+"\n"); f.flush()
+            print(f"[{n}/{len(todo)}] {item['question'][:60]!r} {status}",file=sys.stderr)
+    print(f"done in {time.monotonic()-t0:.0f}s, {failed} failed → {out}",file=sys.stderr)
+    return 1 if failed else 0
+
+if __name__=="__main__": sys.exit(main())
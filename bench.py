@@ -0,0 +1,185 @@
+# Offline benchmark: runs the full discussion pipeline against a local stand-in for every provider API.
+#   python bench.py -n 20 -c 5                      # 20 discussions, 5 at a time
+#   python bench.py -n 50 -c 25 --scale 0.2 --unlimited --set openai.errors=0.1 --json bench.json
+# The mock streams Anthropic, Gemini and OpenAI-style SSE with lognormal time-to-first-token, a fixed delay per
+# chunk, injected 500s and 429s (with Retry-After). History and caches go to a temporary data dir, so real
+# history is never touched, and the response cache's TTL is zeroed so every step pays for its provider calls.
+import argparse
+import concurrent.futures
+import http.server
+import json
+import math
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+PROFILES = {   # median first-token latency (s), lognormal sigma, seconds per chunk, chunks per answer, error rate, 429 rate
+    "anthropic":  {"ttft":0.8,"sigma":0.4,"chunk":0.02,"chunks":40,"errors":0.0,"throttle":0.0},
+    "gemini":     {"ttft":0.6,"sigma":0.5,"chunk":0.02,"chunks":40,"errors":0.02,"throttle":0.02},
+    "openai":     {"ttft":0.7,"sigma":0.5,"chunk":0.02,"chunks":40,"errors":0.02,"throttle":0.02},
+    "perplexity": {"ttft":1.2,"sigma":0.6,"chunk":0.03,"chunks":30,"errors":0.03,"throttle":0.02},
+    "deepseek":   {"ttft":1.5,"sigma":0.7,"chunk":0.03,"chunks":40,"errors":0.03,"throttle":0.02},
+}
+WORDS = "the model weighs evidence against prior claims and notes where the other answers agree or diverge".split()
+
+class MockProviders(http.server.ThreadingHTTPServer):
+    # One server for all providers; the first path segment picks the provider and its latency profile
+    daemon_threads=True
+
+    def __init__(self,profiles,scale=1.0,seed=0):
+        super().__init__(("127.0.0.1",0),_MockHandler)
+        self.profiles,self.scale,self.rng,self.lock=profiles,scale,random.Random(seed),threading.Lock()
+        self.stats={p:{"requests":0,"errors":0,"throttled":0} for p in profiles}
+
+    def url(self,provider): return f"http://127.0.0.1:{self.server_address[1]}/{provider}"+("/v1" if provider in ("openai","deepseek") else "")
+
+    def draw(self,provider):
+        # Decide this request's fate up front: "error", "throttle" or a first-token delay
+        prof=self.profiles[provider]
+        with self.lock:
+            st=self.stats[provider]; st["requests"]+=1; r=self.rng.random()
+            if r<prof["errors"]: st["errors"]+=1; return "error"
+            if r<prof["errors"]+prof["throttle"]: st["throttled"]+=1; return "throttle"
+            return prof["ttft"]*math.exp(self.rng.gauss(0,prof["sigma"]))*self.scale
+
+class _MockHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version="HTTP/1.1"
+
+    def log_message(self,*args): pass
+
+    def _chunk(self,data):
+        b=data.encode(); self.wfile.write(f"{len(b):x}\r\n".encode()+b+b"\r\n"); self.wfile.flush()
+
+    def do_POST(self):
+        body=json.loads(self.rfile.read(int(self.headers.get("content-length") or 0)) or b"{}")
+        provider=self.path.strip("/").split("/")[0]
+        if provider not in self.server.profiles: self.send_error(404); return
+        fate=self.server.draw(provider)
+        if fate in ("error","throttle"):
+            msg=json.dumps({"error":{"type":"overloaded_error" if fate=="throttle" else "api_error","message":f"mock {fate}"}}).encode()
+            self.send_response(429 if fate=="throttle" else 500); self.send_header("content-type","application/json")
+            if fate=="throttle": self.send_header("retry-after",str(round(0.5*self.server.scale,3)))
+            self.send_header("content-length",str(len(msg))); self.end_headers(); self.wfile.write(msg); return
+        self.send_response(200); self.send_header("content-type","text/event-stream"); self.send_header("transfer-encoding","chunked"); self.end_headers()
+        time.sleep(fate)
+        prof=self.server.profiles[provider]; prompt_tokens=len(json.dumps(body))//4; n=prof["chunks"]
+        events=getattr(self,"_"+("anthropic" if provider=="anthropic" else "gemini" if provider=="gemini" else "chat"))(prompt_tokens,n)
+        for i,ev in enumerate(events):
+            self._chunk(ev)
+            if 0<i<=n: time.sleep(prof["chunk"]*self.server.scale)
+        self._chunk("")   # zero-length chunk ends the body
+
+    @staticmethod
+    def _text(i): return WORDS[i%len(WORDS)]+" "
+
+    def _anthropic(self,prompt_tokens,n):
+        def ev(kind,data): return f"event: {kind}\ndata: {json.dumps({'type':kind,**data})}\n\n"
+        yield ev("message_start",{"message":{"id":f"msg_{uuid.uuid4().hex[:12]}","type":"message","role":"assistant","model":"mock","content":[],"stop_reason":None,
+                                             "stop_sequence":None,"usage":{"input_tokens":prompt_tokens,"output_tokens":1}}})
+        yield ev("content_block_start",{"index":0,"content_block":{"type":"text","text":""}})
+        for i in range(n): yield ev("content_block_delta",{"index":0,"delta":{"type":"text_delta","text":self._text(i)}})
+        yield ev("content_block_stop",{"index":0})
+        yield ev("message_delta",{"delta":{"stop_reason":"end_turn","stop_sequence":None},"usage":{"output_tokens":n}})
+        yield ev("message_stop",{})
+
+    def _gemini(self,prompt_tokens,n):
+        for i in range(n): yield f"data: {json.dumps({'candidates':[{'content':{'parts':[{'text':self._text(i)}]}}]})}\n\n"
+        yield f"data: {json.dumps({'usageMetadata':{'promptTokenCount':prompt_tokens,'candidatesTokenCount':n}})}\n\n"
+
+    def _chat(self,prompt_tokens,n):
+        for i in range(n): yield f"data: {json.dumps({'choices':[{'delta':{'content':self._text(i)}}]})}\n\n"
+        yield f"data: {json.dumps({'choices':[],'usage':{'prompt_tokens':prompt_tokens,'completion_tokens':n}})}\n\n"
+        yield "data: [DONE]\n\n"
+
+def pct(xs,q):
+    if not xs: return float("nan")
+    xs=sorted(xs); return xs[min(len(xs)-1,max(0,math.ceil(q/100*len(xs))-1))]
+
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f: return int(f.read().split()[1])*os.sysconf("SC_PAGE_SIZE")/2**20
+    except (OSError,ValueError): return float("nan")
+
+def run(args):
+    profiles={p:dict(v) for p,v in PROFILES.items()}
+    for kv in args.set or []:
+        k,v=kv.split("="); p,field=k.split("."); profiles[p][field]=float(v)
+    mock=MockProviders(profiles,args.scale,args.seed); threading.Thread(target=mock.serve_forever,daemon=True).start()
+    # The app reads keys, endpoints and storage location at import, so configure the environment first
+    os.environ.update({"NEXUS_DATA_DIR":tempfile.mkdtemp(prefix="nexus-bench-"),"NEXUS_STORAGE":"local",
+                       **{f"NEXUS_{p.upper()}_URL":mock.url(p) for p in profiles},
+                       **{k:"mock" for k in ("ANTHROPIC_API_KEY","GEMINI_API_KEY","OPENAI_API_KEY","PERPLEXITY_API_KEY","DEEPSEEK_API_KEY")}})
+    t=time.perf_counter(); import app; import_s=time.perf_counter()-t
+    app.get_engine().cache.ttl=0   # run_parallel and r1 send the same prompts; every lookup must still miss
+    if args.unlimited:
+        for lim in app.RATE_LIMITS.values(): lim.update(rpm=10**6,tpm=10**9,concurrency=10**4)
+    timings,lock={},threading.Lock()
+    def record(phase,dt):
+        with lock: timings.setdefault(phase,[]).append(dt)
+
+    class TimedJob(app.DiscussionJob):
+        def _run_step(self,step,disc):
+            t=time.perf_counter(); apply=super()._run_step(step,disc); record(step,time.perf_counter()-t); return apply
+
+    def discussion(i):
+        app._TRACE.set(None)   # pool threads keep the last job step's trace; don't charge these calls to it
+        t0=time.perf_counter(); q=f"Benchmark question {i} ({uuid.uuid4().hex[:8]}): what limits the throughput of a multi-model debate?"
+        t=time.perf_counter(); app.run_parallel([(p,"initial",q,None,args.model_profile) for p in app.PERSONAS_ORDER]); record("run_parallel",time.perf_counter()-t)
+        disc={"id":str(uuid.uuid4()),"created_at":datetime.now(timezone.utc).replace(tzinfo=None).isoformat(),"question":q,"phase":1,"r1":{},"r2":{},
+              "synthesis":None,"factcheck":None,"followups":[],"context_summary":"","rolling_summary":None,"fallbacks":{},"profile":args.model_profile,
+              "job":{"text_context":"","images":[],"adaptive":args.adaptive}}
+        job=TimedJob(disc,f"bench-{i}"); job.run()
+        disc=job.snapshot(); disc["pending_followup"]={"question":"Which of these limits matters most in practice?","text_context":"","images":[],"context_summary":""}
+        job=TimedJob(disc,f"bench-{i}"); job.run(); disc=job.snapshot()
+        t=time.perf_counter(); app.save_discussion(disc); record("save",time.perf_counter()-t)
+        t=time.perf_counter(); assert app.get_discussion(disc["id"]); record("load",time.perf_counter()-t)
+        t=time.perf_counter(); app.list_history(); record("list",time.perf_counter()-t)
+        record("discussion",time.perf_counter()-t0)
+
+    rss0=rss_mb(); calls0=len(app.get_engine().calls); failed=0; t0=time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(args.concurrency) as pool:
+        for fut in concurrent.futures.as_completed([pool.submit(discussion,i) for i in range(args.discussions)]):
+            try: fut.result()
+            except Exception as e: failed+=1; print(f"discussion failed: {e!r}",file=sys.stderr)
+    wall=time.perf_counter()-t0; done=args.discussions-failed
+    calls=len(app.get_engine().calls)-calls0
+    return {"discussions":args.discussions,"concurrency":args.concurrency,"failed":failed,"wall_s":round(wall,2),"import_s":round(import_s,3),
+            "discussions_per_min":round(done*60/wall,2),"provider_calls":calls,"calls_per_s":round(calls/wall,2),
+            "rss_mb_start":round(rss0,1),"rss_mb_end":round(rss_mb(),1),"peak_rss_mb":round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024,1),
+            "phases":{ph:{"n":len(xs),"p50":round(pct(xs,50),3),"p95":round(pct(xs,95),3),"p99":round(pct(xs,99),3),"max":round(max(xs),3)} for ph,xs in timings.items()},
+            "mock":mock.stats,
+            "breakers":{p:b.state() for p,b in app.get_engine()._breakers.items()}}
+
+def report(res):
+    print(f"{res['discussions']} discussions @ concurrency {res['concurrency']}: {res['wall_s']}s wall, {res['discussions_per_min']}/min, "
+          f"{res['calls_per_s']} provider calls/s, {res['failed']} failed")
+    print(f"memory: rss {res['rss_mb_start']} → {res['rss_mb_end']} MB, peak {res['peak_rss_mb']} MB; app import {res['import_s']}s")
+    print(f"\n{'phase':<14}{'n':>6}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    for ph,s in res["phases"].items(): print(f"{ph:<14}{s['n']:>6}{s['p50']:>9.3f}{s['p95']:>9.3f}{s['p99']:>9.3f}{s['max']:>9.3f}")
+    print("\nmock: "+", ".join(f"{p} {s['requests']} req / {s['errors']} 500 / {s['throttled']} 429" for p,s in res["mock"].items()))
+    if any(v!="closed" for v in res["breakers"].values()): print("breakers: "+", ".join(f"{p} {v}" for p,v in res["breakers"].items()))
+
+def main(argv=None):
+    ap=argparse.ArgumentParser(description="Benchmark the Nexus pipeline against local mock providers.")
+    ap.add_argument("-n","--discussions",type=int,default=10)
+    ap.add_argument("-c","--concurrency",type=int,default=5)
+    ap.add_argument("--scale",type=float,default=1.0,help="multiply every mock delay (e.g. 0.1 for a quick run)")
+    ap.add_argument("--set",action="append",metavar="PROVIDER.FIELD=VALUE",help="override a mock profile value, e.g. openai.errors=0.2")
+    ap.add_argument("--unlimited",action="store_true",help="lift the app's per-provider rate limits to measure the pipeline alone")
+    ap.add_argument("--adaptive",action="store_true",help="allow adaptive rounds (the mock's identical answers always skip the debate)")
+    ap.add_argument("--model-profile",choices=["quality","fast"],default="quality",help="model tier profile for the app (see TIER_PROFILES in app.py)")
+    ap.add_argument("--seed",type=int,default=0)
+    ap.add_argument("--json",help="also write the results here")
+    args=ap.parse_args(argv)
+    res=run(args); report(res)
+    if args.json:
+        with open(args.json,"w",encoding="utf-8") as f: json.dump(res,f,indent=2)
+    return 1 if res["failed"] else 0
+
+if __name__=="__main__": sys.exit(main())
@@ -0,0 +1,15 @@
+# PDF text extraction that can run inside a process pool. It lives outside app.py because
+# Streamlit executes app.py as __main__, which worker processes cannot import by name.
+import io
+
+def page_texts(src,start=0,stop=None,budget=None):
+    # Text of pages[start:stop], stopping once `budget` characters are collected; also returns the page count.
+    # `src` is the PDF's bytes or, for pool workers, a path, so the document isn't pickled once per task.
+    import pdfplumber
+    out,n=[],0
+    with pdfplumber.open(src if isinstance(src,str) else io.BytesIO(src)) as pdf:
+        total=len(pdf.pages)
+        for page in pdf.pages[start:stop]:
+            t=page.extract_text() or ""; getattr(page,"close",lambda:None)(); out.append(t); n+=len(t)
+            if budget is not None and n>budget: break
+    return out,total